@@ -1,36 +1,171 @@
+import hashlib
+import hmac
 import secrets
-from typing import Dict
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Tuple
 
 from fastapi import HTTPException, status
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
 from . import models
 
-# token -> user_id
-TOKENS: Dict[str, int] = {}
+# Vigencia de un token desde el login
+TOKEN_TTL = timedelta(hours=24)
 
+# Parámetros de scrypt para el hash de contraseñas (~50 ms, 16 MiB por hash)
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+_HASH_PREFIX = "scrypt$"
 
-def create_token_for_user(user: models.Usuario) -> str:
-    """Genera un token aleatorio y lo asocia al usuario en memoria."""
+# Segundos durante los que se reutilizan los datos del usuario sin ir a la BD
+USER_CACHE_TTL = 60
+# Máximo de tokens en caché por proceso (acota la memoria)
+USER_CACHE_MAXSIZE = 10_000
+
+
+class UsuarioCache(NamedTuple):
+    """Datos mínimos del usuario autenticado (sin atarse a una Session)."""
+    id: int
+    usuario: str
+    nombre: str
+
+
+# token -> (usuario, timestamp hasta el que la entrada es válida), en orden
+# de inserción (la primera es la más antigua)
+_USER_CACHE: OrderedDict[str, Tuple[UsuarioCache, float]] = OrderedDict()
+# Las rutas síncronas corren en el threadpool: toda lectura / escritura de
+# _USER_CACHE va con este lock
+_USER_CACHE_LOCK = threading.Lock()
+
+
+def hash_password(password: str) -> str:
+    """Devuelve 'scrypt$n$r$p$salt$hash' (hex) para guardar en contrasenia."""
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(
+        password.encode("utf-8"),
+        salt=salt,
+        n=SCRYPT_N,
+        r=SCRYPT_R,
+        p=SCRYPT_P,
+        dklen=32,
+    )
+    return f"{_HASH_PREFIX}{SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+
+def password_needs_rehash(stored: str) -> bool:
+    """True si la contraseña guardada es antigua (texto plano, sin hash)."""
+    return not stored.startswith(_HASH_PREFIX)
+
+
+def verify_password(password: str, stored: str) -> bool:
+    """
+    Compara la contraseña con la guardada en tiempo constante.
+    Acepta también contraseñas antiguas en texto plano para poder migrarlas.
+    """
+    if password_needs_rehash(stored):
+        return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8"))
+
+    try:
+        _, n, r, p, salt, digest = stored.split("$")
+        calculado = hashlib.scrypt(
+            password.encode("utf-8"),
+            salt=bytes.fromhex(salt),
+            n=int(n),
+            r=int(r),
+            p=int(p),
+            dklen=len(digest) // 2,
+        )
+    except ValueError:
+        return False
+
+    return hmac.compare_digest(calculado.hex(), digest)
+
+
+def _liberar_cache(ahora: float) -> None:
+    """Hace sitio en la caché desde el principio (lo más antiguo): descarta
+    las entradas vencidas que haya ahí y, si sigue llena, la más antigua.
+    No recorre toda la caché. Se llama con _USER_CACHE_LOCK tomado."""
+    while _USER_CACHE and next(iter(_USER_CACHE.values()))[1] <= ahora:
+        _USER_CACHE.popitem(last=False)
+    while len(_USER_CACHE) >= USER_CACHE_MAXSIZE:
+        _USER_CACHE.popitem(last=False)
+
+
+def _cachear_usuario(token: str, user: models.Usuario, expira_en: datetime) -> UsuarioCache:
+    cached = UsuarioCache(id=user.id, usuario=user.usuario, nombre=user.nombre)
+    ahora = time.time()
+    valido_hasta = min(ahora + USER_CACHE_TTL, expira_en.timestamp())
+
+    with _USER_CACHE_LOCK:
+        _USER_CACHE.pop(token, None)
+        if len(_USER_CACHE) >= USER_CACHE_MAXSIZE:
+            _liberar_cache(ahora)
+        _USER_CACHE[token] = (cached, valido_hasta)
+    return cached
+
+
+def create_token_for_user(db: Session, user: models.Usuario) -> str:
+    """
+    Genera un token aleatorio y lo guarda en la tabla token_sesion, de modo
+    que sea válido en cualquier worker de la API. Hace commit de la sesión.
+    """
     token = secrets.token_hex(32)
-    TOKENS[token] = user.id
+    expira_en = datetime.now(timezone.utc) + TOKEN_TTL
+    _cachear_usuario(token, user, expira_en)
+
+    # Aprovechamos para limpiar los tokens vencidos del usuario
+    db.query(models.TokenSesion).filter(
+        models.TokenSesion.id_usuario == user.id,
+        models.TokenSesion.expira_en <= func.now(),
+    ).delete(synchronize_session=False)
+
+    db.add(models.TokenSesion(token=token, id_usuario=user.id, expira_en=expira_en))
+    db.commit()
     return token
 
 
-def get_user_by_token(db: Session, token: str) -> models.Usuario:
-    """Obtiene el usuario asociado a un token o lanza 401."""
-    user_id = TOKENS.get(token)
-    if not user_id:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Token inválido o expirado",
-        )
+def revoke_token(db: Session, token: str) -> None:
+    """Invalida un token (logout) y su entrada en caché. Hace commit."""
+    with _USER_CACHE_LOCK:
+        _USER_CACHE.pop(token, None)
+    db.query(models.TokenSesion).filter(
+        models.TokenSesion.token == token
+    ).delete(synchronize_session=False)
+    db.commit()
+
 
-    user = db.get(models.Usuario, user_id)
-    if not user:
+def get_user_by_token(db: Session, token: str) -> UsuarioCache:
+    """
+    Obtiene el usuario asociado a un token o lanza 401.
+    Usa la caché en memoria y, si la entrada no existe o ya expiró, resuelve
+    token y usuario en una sola consulta.
+    """
+    with _USER_CACHE_LOCK:
+        entry = _USER_CACHE.get(token)
+    if entry and time.time() < entry[1]:
+        return entry[0]
+
+    row = (
+        db.query(models.Usuario, models.TokenSesion.expira_en)
+        .join(models.TokenSesion, models.TokenSesion.id_usuario == models.Usuario.id)
+        .filter(
+            models.TokenSesion.token == token,
+            models.TokenSesion.expira_en > func.now(),
+        )
+        .first()
+    )
+    if not row:
+        with _USER_CACHE_LOCK:
+            _USER_CACHE.pop(token, None)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Usuario no encontrado",
+            detail="Token inválido o expirado",
         )
 
-    return user
+    user, expira_en = row
+    return _cachear_usuario(token, user, expira_en)
@@ -0,0 +1,78 @@
+import io
+from typing import Any, Dict, List
+
+from sqlalchemy.orm import Session
+
+from . import models
+
+# A partir de cuántas filas se usa COPY en vez de INSERT multi-fila
+BULK_COPY_UMBRAL = 100
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _valor_copy(valor: Any) -> str:
+    """Formatea un valor para COPY ... FROM STDIN en formato text."""
+    if valor is None:
+        return "\\N"
+    if isinstance(valor, bool):
+        return "t" if valor else "f"
+    if isinstance(valor, (int, float)):
+        return repr(valor)
+    if hasattr(valor, "isoformat"):
+        return valor.isoformat()
+    return str(valor).translate(_COPY_ESCAPES)
+
+
+def _copy_filas(db: Session, tabla, filas: List[Dict[str, Any]]) -> None:
+    """
+    Inserta `filas` en `tabla` con COPY dentro de la transacción de la
+    sesión. Las geometrías llegan como WKT y se envían como EWKT
+    ('SRID=4326;POINT(...)'), que es lo que acepta geometry(...,4326).
+    """
+    columnas = list(filas[0])
+    srids = {
+        c: tabla.c[c].type.srid
+        for c in columnas
+        if isinstance(tabla.c[c].type, models.Geometria)
+    }
+    buf = io.StringIO()
+    for fila in filas:
+        valores = []
+        for c in columnas:
+            valor = fila[c]
+            if c in srids and valor is not None:
+                valor = f"SRID={srids[c]};{valor}"
+            valores.append(_valor_copy(valor))
+        buf.write("\t".join(valores))
+        buf.write("\n")
+    buf.seek(0)
+
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {tabla.name} ({', '.join(columnas)}) FROM STDIN",
+            buf,
+        )
+    finally:
+        cursor.close()
+
+
+def _insertar_filas(db: Session, sentencia, filas: List[Dict[str, Any]]) -> None:
+    """INSERT multi-fila para lotes pequeños y COPY para los grandes. No hace commit."""
+    if not filas:
+        return
+    if len(filas) > BULK_COPY_UMBRAL:
+        _copy_filas(db, sentencia.table, filas)
+    else:
+        db.execute(sentencia, filas)
+
+
+def bulk_insert_estructuras(db: Session, filas: List[Dict[str, Any]]) -> None:
+    """Inserta estructuras hidráulicas (dicts con las columnas de la tabla)."""
+    _insertar_filas(db, models.INSERT_ESTRUCTURA, filas)
+
+
+def bulk_insert_tuberias(db: Session, filas: List[Dict[str, Any]]) -> None:
+    """Inserta tuberías (dicts con las columnas de la tabla, incluido el id)."""
+    _insertar_filas(db, models.INSERT_TUBERIA, filas)
@@ -1,5 +1,7 @@
+import os
+
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.orm import DeclarativeBase, sessionmaker
 
 # 👇 AJUSTA ESTOS DATOS A TU ENTORNO REAL
 DB_USER = "postgres"
@@ -8,13 +10,39 @@ DB_HOST = "localhost"
 DB_PORT = "5432"
 DB_NAME = "inspectpozo_2"
 
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# Driver fijo: bulk_utils usa copy_expert, que es propio de psycopg2
+DATABASE_URL = f"postgresql+psycopg2://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+# Tamaño del pool por proceso (ajustable por entorno según workers y el
+# max_connections de Postgres / PgBouncer)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
 
-# Motor de conexión
-engine = create_engine(DATABASE_URL, future=True)
+# Motor de conexión con pool de conexiones reutilizables:
+# - pool_pre_ping descarta conexiones muertas (p. ej. tras timeouts de Postgres)
+# - pool_recycle renueva conexiones antes de que el servidor las cierre
+# - pool_use_lifo reutiliza primero las conexiones más recientes (más "calientes")
+# - query_cache_size: caché de SQL compilado, holgada para todas las sentencias de la API
+engine = create_engine(
+    DATABASE_URL,
+    future=True,
+    echo=False,
+    query_cache_size=1200,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=30,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    pool_use_lifo=True,
+)
 
 # Sesiones
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+# expire_on_commit=False: tras el commit los objetos conservan sus valores,
+# así las rutas pueden devolverlos sin un SELECT extra (db.refresh)
+SessionLocal = sessionmaker(
+    bind=engine, autoflush=False, autocommit=False, expire_on_commit=False
+)
 
 # Base ORM
-Base = declarative_base()
+class Base(DeclarativeBase):
+    pass
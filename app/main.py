@@ -6,28 +6,61 @@ from fastapi import (
     UploadFile,
     File,
     Form,
+    Request,
+    Response,
 )
 
-from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from sqlalchemy import text
-from typing import Tuple, List, Dict, Any
+from fastapi.responses import ORJSONResponse
+from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from sqlalchemy.orm import Session, load_only, raiseload
+from sqlalchemy import text, func, select, delete, cast, bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from typing import List, Dict, Any, Optional
+from pydantic import TypeAdapter
+from collections import Counter
+from contextlib import asynccontextmanager
+import anyio
 import hashlib
 import json
 import shutil
 from pathlib import Path
 import base64  # para codificar/decodificar imágenes en base64
+import struct
 
-from .database import SessionLocal, engine, Base
+from .database import SessionLocal, engine, Base, DB_POOL_SIZE, DB_MAX_OVERFLOW
 from . import models, schemas
-from .auth_utils import create_token_for_user, get_user_by_token
+from .auth_utils import (
+    UsuarioCache,
+    create_token_for_user,
+    get_user_by_token,
+    revoke_token,
+    hash_password,
+    verify_password,
+    password_needs_rehash,
+)
+from .migraciones import aplicar_migraciones
+from .bulk_utils import bulk_insert_estructuras, bulk_insert_tuberias
 
 Base.metadata.create_all(bind=engine)
+aplicar_migraciones(engine)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Las rutas son síncronas y FastAPI las ejecuta en el threadpool de anyio
+    # (40 hilos por defecto). Solo se sube, hasta el máximo de conexiones del
+    # pool (DB_POOL_SIZE + DB_MAX_OVERFLOW), si ese máximo es mayor: así los
+    # hilos no limitan la concurrencia por debajo del pool. Nunca se baja
+    # (con los valores por defecto, 20 + 10, queda en 40).
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(limiter.total_tokens, DB_POOL_SIZE + DB_MAX_OVERFLOW)
+    yield
+
 
 app = FastAPI(
     title="InspectPozo API",
     version="2.2.0",
     description="Backend para app InspectPozo (usuarios, proyectos, estructuras hidráulicas y tuberías).",
+    lifespan=lifespan,
 )
 
 # Directorio donde se guardarán las fotos de registro (si en algún momento decides usar disco)
@@ -35,7 +68,6 @@ BASE_DIR = Path(__file__).resolve().parent
 PHOTO_UPLOAD_DIR = BASE_DIR / "uploads" / "fotos"
 PHOTO_UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
-
 # ==========================
 #       DEPENDENCIA DB
 # ==========================
@@ -48,78 +80,223 @@ def get_db():
         db.close()
 
 
+# ==========================
+#    DEPENDENCIA USUARIO
+# ==========================
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login", auto_error=False)
+
+
+def get_token(
+    bearer_token: Optional[str] = Depends(oauth2_scheme),
+    token: Optional[str] = None,
+) -> str:
+    """
+    Token de la petición: cabecera 'Authorization: Bearer <token>' o,
+    por compatibilidad con clientes antiguos, query param 'token'.
+    """
+    valor = bearer_token or token
+    if not valor:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="No autenticado",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return valor
+
+
+def get_current_user(
+    request: Request,
+    token: str = Depends(get_token),
+    db: Session = Depends(get_db),
+) -> UsuarioCache:
+    """Usuario autenticado; se resuelve una sola vez por petición."""
+    user = getattr(request.state, "user", None)
+    if user is None:
+        user = get_user_by_token(db, token)
+        request.state.user = user
+    return user
+
+
 @app.get("/ping")
 def ping():
     return {"ping": "pong"}
 
 
 # ==========================
-#   HELPER WKT PARA TUBERÍAS
+#   HELPER EXTREMOS TUBERÍAS
 # ==========================
 
-def _parse_point_wkt(wkt: str) -> Tuple[float, float]:
+# Sentencia precompilada a nivel de módulo: se construye una sola vez y
+# SQLAlchemy reutiliza su forma compilada en cada creación de tubería.
+_Q_EXTREMOS_TUBERIA = text(
     """
-    Parsea un WKT tipo 'POINT(x y)' y devuelve (x, y).
-    Lanza ValueError si el formato no es válido.
+    SELECT
+      e.id,
+      e.id_proyecto,
+      p.id_usuario,
+      e.cota_estructura,
+      e.lon AS x,
+      e.lat AS y
+    FROM estructura_hidraulica e
+    JOIN proyecto p ON p.id = e.id_proyecto
+    WHERE e.id IN :ids
     """
-    if not wkt:
-        raise ValueError("WKT vacío")
+).bindparams(bindparam("ids", expanding=True))
 
-    txt = wkt.strip()
-    if not txt.lower().startswith("point(") or not txt.endswith(")"):
-        raise ValueError(f"Formato WKT no soportado: {txt}")
 
-    inner = txt[txt.find("(") + 1: -1].strip()
-    parts = inner.replace(",", " ").split()
-    if len(parts) != 2:
-        raise ValueError(f"POINT debe tener 2 coordenadas: {inner}")
+def _get_extremos_tuberia(db: Session, ids_estructura) -> Dict[str, Any]:
+    """
+    Obtiene en una sola consulta las estructuras extremo de una o varias
+    tuberías (id, id_proyecto, id_usuario dueño del proyecto, cota_estructura
+    y las coordenadas x/y del POINT, de las columnas generadas lon/lat).
+    Devuelve un dict {id_estructura: fila}; las que no existen no aparecen.
+    """
+    filas = db.execute(
+        _Q_EXTREMOS_TUBERIA,
+        {"ids": list(set(ids_estructura))},
+    ).all()
 
-    x = float(parts[0])
-    y = float(parts[1])
-    return x, y
+    return {fila.id: fila for fila in filas}
 
 
-def _parse_linestring_wkt(wkt: str) -> List[List[float]]:
+def _fila_tuberia(data: schemas.PipeCreate, extremos: Dict[str, Any], user_id: int) -> Dict[str, Any]:
     """
-    Parsea un WKT tipo 'LINESTRING(x1 y1, x2 y2, ...)' y devuelve
-    [[x1, y1], [x2, y2], ...].
+    Valida los extremos de una tubería y devuelve sus columnas (sin id):
+    geometría LINESTRING entre los POINT de inicio y destino y cotas clave
+    calculadas como cota_estructura - profundidad_clave.
+    Lanza 404 / 403 / 400 si algún extremo no existe, no es del usuario,
+    no tiene geometría POINT o si inicio y destino son la misma estructura.
     """
-    if not wkt:
-        return []
+    est_inicio = extremos.get(data.id_estructura_inicio)
+    est_dest = extremos.get(data.id_estructura_destino)
 
-    txt = wkt.strip()
-    if not txt.lower().startswith("linestring(") or not txt.endswith(")"):
-        return []
+    if not est_inicio or not est_dest:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Estructura de inicio o destino no encontrada",
+        )
 
-    inner = txt[txt.find("(") + 1: -1].strip()
-    parts = inner.split(",")
+    if data.id_estructura_inicio == data.id_estructura_destino:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="La estructura de inicio y la de destino deben ser distintas",
+        )
 
-    coords: List[List[float]] = []
-    for part in parts:
-        tokens = part.strip().split()
-        if len(tokens) != 2:
-            continue
-        x = float(tokens[0])
-        y = float(tokens[1])
-        coords.append([x, y])
+    # Ambas estructuras deben pertenecer a proyectos del usuario
+    if est_inicio.id_usuario != user_id or est_dest.id_usuario != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Las estructuras no pertenecen a proyectos del usuario",
+        )
 
-    return coords
+    # Geometría de la tubería (LINESTRING) a partir de las de las estructuras
+    if None in (est_inicio.x, est_inicio.y, est_dest.x, est_dest.y):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=(
+                "No se pudo construir la geometría de la tubería. "
+                "Verifica que las estructuras tengan geometría POINT válida."
+            ),
+        )
 
+    geom = (
+        f"LINESTRING({est_inicio.x} {est_inicio.y}, "
+        f"{est_dest.x} {est_dest.y})"
+    )
 
-def _get_point_from_structure(db: Session, estructura_id: str) -> Tuple[float, float]:
+    # cota_clave = cota_estructura - profundidad_clave
+    cota_clave_inicio_calc = data.cota_clave_inicio
+    if est_inicio.cota_estructura is not None and data.profundidad_clave_inicio is not None:
+        cota_clave_inicio_calc = (
+            est_inicio.cota_estructura - data.profundidad_clave_inicio
+        )
+
+    cota_clave_destino_calc = data.cota_clave_destino
+    if est_dest.cota_estructura is not None and data.profundidad_clave_destino is not None:
+        cota_clave_destino_calc = (
+            est_dest.cota_estructura - data.profundidad_clave_destino
+        )
+
+    return dict(
+        diametro=data.diametro,
+        material=data.material,
+        flujo=data.flujo,
+        estado=data.estado,
+        sedimento=data.sedimento,
+        cota_clave_inicio=cota_clave_inicio_calc,
+        cota_batea_inicio=data.cota_batea_inicio,
+        profundidad_clave_inicio=data.profundidad_clave_inicio,
+        profundidad_batea_inicio=data.profundidad_batea_inicio,
+        cota_clave_destino=cota_clave_destino_calc,
+        cota_batea_destino=data.cota_batea_destino,
+        profundidad_clave_destino=data.profundidad_clave_destino,
+        profundidad_batea_destino=data.profundidad_batea_destino,
+        grados=data.grados,
+        observaciones=data.observaciones,
+        geometria=geom,
+        id_estructura_inicio=data.id_estructura_inicio,
+        id_estructura_destino=data.id_estructura_destino,
+    )
+
+
+# ==========================
+#   HELPER IDS INCREMENTALES
+# ==========================
+
+def _id_estructura_ocupado(db: Session, prefix: str, num: int) -> bool:
     """
-    Obtiene la geometría de una estructura como WKT usando ST_AsText
-    (soporta columnas geometry/WKB) y devuelve (x, y) del POINT.
+    True si ya hay una estructura con ese prefijo y sufijo numérico (sin
+    distinguir mayúsculas ni ceros a la izquierda: 'PZ0042' ocupa pz/42).
+    Se resuelve con el índice (prefijo, sufijo) de la tabla.
     """
-    wkt = db.execute(
-        text("SELECT ST_AsText(geometria) FROM estructura_hidraulica WHERE id = :id"),
-        {"id": estructura_id},
+    columna = models.EstructuraHidraulica.id
+    return db.query(
+        select(columna)
+        .where(
+            models.prefijo_id(columna) == prefix,
+            models.sufijo_id(columna) == num,
+        )
+        .exists()
     ).scalar()
 
-    if not wkt:
-        raise ValueError(f"Estructura {estructura_id} sin geometría o no existe")
 
-    return _parse_point_wkt(wkt)
+# ==========================
+#    HELPER LISTAS JSON
+# ==========================
+
+def _json_lista(adaptador: TypeAdapter, filas: List[Any]) -> Response:
+    """
+    Valida y serializa un listado con el TypeAdapter de su esquema
+    (una sola pasada en pydantic-core) y lo devuelve ya como JSON.
+    """
+    return Response(
+        content=adaptador.dump_json(adaptador.validate_python(filas)),
+        media_type="application/json",
+    )
+
+
+# ==========================
+#       HELPER ETAG
+# ==========================
+
+def _etag(*partes: Any) -> str:
+    """ETag a partir del estado de los datos (conteos, última modificación)."""
+    return '"' + hashlib.sha1("|".join(map(str, partes)).encode("utf-8")).hexdigest() + '"'
+
+
+def _no_modificado(request: Request, etag: str) -> Optional[Response]:
+    """Respuesta 304 si el cliente ya tiene la versión `etag`; si no, None."""
+    enviados = request.headers.get("if-none-match")
+    if not enviados:
+        return None
+    valores = {v.strip().removeprefix("W/") for v in enviados.split(",")}
+    if etag in valores or "*" in valores:
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            headers={"ETag": etag},
+        )
+    return None
 
 
 # ==========================
@@ -133,34 +310,41 @@ def login(
 ):
     user = (
         db.query(models.Usuario)
-        .filter(
-            models.Usuario.usuario == form_data.username,
-            models.Usuario.contrasenia == form_data.password,
-        )
+        .filter(models.Usuario.usuario == form_data.username)
         .first()
     )
 
-    if not user:
+    if not user or not verify_password(form_data.password, user.contrasenia):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Usuario o contraseña incorrectos",
         )
 
-    token = create_token_for_user(user)
+    # Las contraseñas antiguas en texto plano se guardan con hash al iniciar sesión
+    # (el commit lo hace create_token_for_user)
+    if password_needs_rehash(user.contrasenia):
+        user.contrasenia = hash_password(form_data.password)
+
+    token = create_token_for_user(db, user)
+
     return schemas.TokenResponse(access_token=token)
 
 
 @app.get("/auth/me", response_model=schemas.MeResponse)
 def get_me(
-    token: str,
+    user: UsuarioCache = Depends(get_current_user),
+):
+    return schemas.MeResponse.model_validate(user)
+
+
+@app.post("/auth/logout")
+def logout(
+    token: str = Depends(get_token),
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    user = get_user_by_token(db, token)
-    return schemas.MeResponse(
-        id=user.id,
-        usuario=user.usuario,
-        nombre=user.nombre,
-    )
+    revoke_token(db, token)
+    return {"ok": True}
 
 
 @app.post("/auth/register", response_model=schemas.UserOut)
@@ -168,33 +352,44 @@ def register_user(
     data: schemas.UserCreate,
     db: Session = Depends(get_db),
 ):
-    existing = (
-        db.query(models.Usuario)
-        .filter(models.Usuario.usuario == data.usuario)
-        .first()
-    )
-    if existing:
+    # Alta y verificación de usuario repetido en una sola sentencia (sin
+    # carrera entre dos registros simultáneos): si ya existe no hay fila
+    nuevo = db.execute(
+        pg_insert(models.Usuario)
+        .values(
+            usuario=data.usuario,
+            contrasenia=hash_password(data.contrasenia),
+            nombre=data.nombre,
+        )
+        .on_conflict_do_nothing(index_elements=[models.Usuario.usuario])
+        .returning(models.Usuario.id, models.Usuario.usuario, models.Usuario.nombre)
+    ).mappings().first()
+
+    if nuevo is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="El usuario ya existe",
         )
 
-    nuevo = models.Usuario(
-        usuario=data.usuario,
-        contrasenia=data.contrasenia,
-        nombre=data.nombre,
-    )
-
-    db.add(nuevo)
     db.commit()
-    db.refresh(nuevo)
 
     return nuevo
 
 
 @app.get("/usuarios", response_model=list[schemas.UserOut])
 def listar_usuarios(db: Session = Depends(get_db)):
-    return db.query(models.Usuario).all()
+    # Solo las columnas de UserOut (no se trae el hash de la contraseña)
+    return (
+        db.query(models.Usuario)
+        .options(
+            load_only(
+                models.Usuario.id,
+                models.Usuario.usuario,
+                models.Usuario.nombre,
+            )
+        )
+        .all()
+    )
 
 
 # ==========================
@@ -203,12 +398,10 @@ def listar_usuarios(db: Session = Depends(get_db)):
 
 @app.post("/proyectos/", response_model=schemas.ProjectOut)
 def crear_proyecto(
-    token: str,
     data: schemas.ProjectCreate,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    user = get_user_by_token(db, token)
-
     proyecto = models.Proyecto(
         nombre=data.nombre,
         contrato=data.contrato,
@@ -220,51 +413,73 @@ def crear_proyecto(
 
     db.add(proyecto)
     db.commit()
-    db.refresh(proyecto)
 
     return proyecto
 
 
 @app.get("/proyectos/", response_model=list[schemas.ProjectDetailOut])
 def listar_proyectos(
-    token: str,
+    request: Request,
+    response: Response,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    user = get_user_by_token(db, token)
-
-    proyectos = (
-        db.query(models.Proyecto)
+    # ETag: cantidad de proyectos + última modificación; si el cliente ya
+    # tiene esa versión se responde 304 sin cargar la lista
+    total, ultima = (
+        db.query(func.count(models.Proyecto.id), func.max(models.Proyecto.actualizado_en))
         .filter(models.Proyecto.id_usuario == user.id)
-        .all()
+        .one()
     )
+    etag = _etag(user.id, total, ultima)
+    no_modificado = _no_modificado(request, etag)
+    if no_modificado:
+        return no_modificado
+    response.headers["ETag"] = etag
+
+    # Listado de solo lectura: select de Core con las columnas del esquema
+    # de salida, sin materializar objetos ORM ni pasar por el identity map
+    filas = db.execute(
+        select(
+            models.Proyecto.id,
+            models.Proyecto.nombre,
+            models.Proyecto.contrato,
+            models.Proyecto.contratante,
+            models.Proyecto.contratista,
+            models.Proyecto.encargado,
+            models.Proyecto.id_usuario,
+        )
+        .where(models.Proyecto.id_usuario == user.id)
+        .order_by(models.Proyecto.id)
+    ).mappings().all()
 
+    proyectos: List[Dict[str, Any]] = [dict(r) for r in filas]
     return proyectos
 
 
 @app.delete("/proyectos/{proyecto_id}")
 def eliminar_proyecto(
     proyecto_id: int,
-    token: str,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    user = get_user_by_token(db, token)
-
-    proyecto = (
-        db.query(models.Proyecto)
-        .filter(
+    # Borrado y verificación de dueño en una sola sentencia; las estructuras,
+    # tuberías y fotos dependientes las elimina Postgres (ON DELETE CASCADE)
+    borrado = db.execute(
+        delete(models.Proyecto)
+        .where(
             models.Proyecto.id == proyecto_id,
             models.Proyecto.id_usuario == user.id,
         )
-        .first()
-    )
+        .returning(models.Proyecto.id)
+    ).scalar()
 
-    if not proyecto:
+    if borrado is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Proyecto no encontrado",
         )
 
-    db.delete(proyecto)
     db.commit()
 
     return {"ok": True}
@@ -273,40 +488,23 @@ def eliminar_proyecto(
 @app.put("/proyectos/{proyecto_id}", response_model=schemas.ProjectOut)
 def actualizar_proyecto(
     proyecto_id: int,
-    token: str,
     data: schemas.ProjectUpdate,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    user = get_user_by_token(db, token)
+    proyecto = db.get(models.Proyecto, proyecto_id)
 
-    proyecto = (
-        db.query(models.Proyecto)
-        .filter(
-            models.Proyecto.id == proyecto_id,
-            models.Proyecto.id_usuario == user.id,
-        )
-        .first()
-    )
-
-    if not proyecto:
+    if not proyecto or proyecto.id_usuario != user.id:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Proyecto no encontrado o no pertenece al usuario",
         )
 
-    if data.nombre is not None:
-        proyecto.nombre = data.nombre
-    if data.contrato is not None:
-        proyecto.contrato = data.contrato
-    if data.contratante is not None:
-        proyecto.contratante = data.contratante
-    if data.contratista is not None:
-        proyecto.contratista = data.contratista
-    if data.encargado is not None:
-        proyecto.encargado = data.encargado
+    # Solo los campos enviados con valor (los None se ignoran)
+    for campo, valor in data.model_dump(exclude_unset=True, exclude_none=True).items():
+        setattr(proyecto, campo, valor)
 
     db.commit()
-    db.refresh(proyecto)
 
     return proyecto
 
@@ -318,16 +516,9 @@ def actualizar_proyecto(
 @app.get("/estructuras/next-id")
 def get_next_estructura_id(
     tipo: str,
-    token: str,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    user = get_user_by_token(db, token)
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Token inválido o usuario no encontrado",
-        )
-
     tipo_norm = tipo.strip().lower()
     if tipo_norm == "pozo":
         prefix = "pz"
@@ -336,23 +527,14 @@ def get_next_estructura_id(
     else:
         prefix = "es"
 
-    rows = (
-        db.query(models.EstructuraHidraulica.id)
-        .filter(models.EstructuraHidraulica.id.ilike(f"{prefix}%"))
-        .all()
-    )
+    # Cada llamada reserva un número de la secuencia del prefijo: dos
+    # clientes simultáneos nunca reciben el mismo ID. Se saltan los números
+    # ya usados por IDs cargados a mano por encima de la secuencia.
+    secuencia = models.ESTRUCTURA_ID_SEQS[prefix]
+    next_num = db.execute(select(secuencia.next_value())).scalar()
+    while _id_estructura_ocupado(db, prefix, next_num):
+        next_num = db.execute(select(secuencia.next_value())).scalar()
 
-    max_num = 0
-    for (sid,) in rows:
-        try:
-            num_part = sid[len(prefix):]
-            num = int(num_part)
-            if num > max_num:
-                max_num = num
-        except (IndexError, ValueError):
-            continue
-
-    next_num = max_num + 1
     new_id = f"{prefix}{next_num:04d}"
 
     return {"id": new_id}
@@ -361,65 +543,155 @@ def get_next_estructura_id(
 @app.post("/estructuras/", response_model=schemas.EstructuraHidraulicaOut)
 def crear_estructura_hidraulica(
     data: schemas.EstructuraHidraulicaCreate,
-    token: str,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    user = get_user_by_token(db, token)
-
-    proyecto = (
-        db.query(models.Proyecto)
-        .filter(
+    # INSERT ... SELECT ... WHERE EXISTS: la verificación de que el proyecto
+    # es del usuario va en la misma sentencia que el alta (un solo viaje).
+    # Cada valor se castea al tipo de su columna para que los NULL no se
+    # interpreten como text. Un ID repetido tampoco inserta (ON CONFLICT).
+    tabla = models.EstructuraHidraulica.__table__
+    valores = data.model_dump()
+    columnas = list(valores)
+
+    proyecto_del_usuario = (
+        select(models.Proyecto.id)
+        .where(
             models.Proyecto.id == data.id_proyecto,
             models.Proyecto.id_usuario == user.id,
         )
-        .first()
+        .exists()
     )
+    creado = db.execute(
+        pg_insert(tabla)
+        .from_select(
+            columnas,
+            select(
+                *[cast(valores[c], tabla.c[c].type).label(c) for c in columnas]
+            ).where(proyecto_del_usuario),
+        )
+        .on_conflict_do_nothing(index_elements=[tabla.c.id])
+        .returning(tabla.c.id)
+    ).scalar()
 
-    if not proyecto:
+    if creado is None:
+        # Solo en el caso de error se distingue la causa
+        existente = db.get(
+            models.EstructuraHidraulica,
+            data.id,
+            options=[load_only(models.EstructuraHidraulica.id)],
+        )
+        if existente is not None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="La estructura ya existe",
+            )
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Proyecto no encontrado o no pertenece al usuario",
         )
 
-    estructura = models.EstructuraHidraulica(
-        id=data.id,
-        tipo=data.tipo,
-        geometria=data.geometria,
-        fecha_inspeccion=data.fecha_inspeccion,
-        hora_inspeccion=data.hora_inspeccion,
-        clima_inspeccion=data.clima_inspeccion,
-        tipo_via=data.tipo_via,
-        tipo_sistema=data.tipo_sistema,
-        material=data.material,
-        cono_reduccion=data.cono_reduccion,
-        altura_cono=data.altura_cono,
-        profundidad_pozo=data.profundidad_pozo,
-        diametro_camara=data.diametro_camara,
-        sedimentacion=data.sedimentacion,
-        cobertura_tuberia_salida=data.cobertura_tuberia_salida,
-        deposito_predomina=data.deposito_predomina,
-        flujo_represado=data.flujo_represado,
-        nivel_cubre_cotasalida=data.nivel_cubre_cotasalida,
-        cota_estructura=data.cota_estructura,
-        condiciones_investiga=data.condiciones_investiga,
-        observaciones=data.observaciones,
-        tipo_sumidero=data.tipo_sumidero,
-        ancho_sumidero=data.ancho_sumidero,
-        largo_sumidero=data.largo_sumidero,
-        altura_sumidero=data.altura_sumidero,
-        ancho_rejilla=data.ancho_rejilla,
-        largo_rejilla=data.largo_rejilla,
-        altura_rejilla=data.altura_rejilla,
-        material_rejilla=data.material_rejilla,
-        id_proyecto=data.id_proyecto,
-        material_sumidero=data.material_sumidero,
+    db.commit()
+
+    return data
+
+
+@app.post("/estructuras/bulk")
+def crear_estructuras_bulk(
+    datos: List[schemas.EstructuraHidraulicaCreate],
+    user: UsuarioCache = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """
+    Crea varias estructuras en una sola transacción (p. ej. importación
+    desde CSV o sincronización desde la app) con un solo commit: INSERT
+    multi-fila para lotes pequeños y COPY para los grandes (ver bulk_utils).
+    Todos los proyectos referenciados deben pertenecer al usuario.
+    """
+    if not datos:
+        return {"ok": True, "insertadas": 0}
+
+    ids_proyecto = {d.id_proyecto for d in datos}
+    propios = (
+        db.query(func.count(models.Proyecto.id))
+        .filter(
+            models.Proyecto.id.in_(ids_proyecto),
+            models.Proyecto.id_usuario == user.id,
+        )
+        .scalar()
     )
+    if propios != len(ids_proyecto):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Proyecto no encontrado o no pertenece al usuario",
+        )
+
+    # IDs repetidos en el lote o ya existentes: 400 como en POST /estructuras/
+    # (una sola consulta para todo el lote)
+    ids = [d.id for d in datos]
+    repetidos = {id_est for id_est, n in Counter(ids).items() if n > 1}
+    repetidos.update(
+        db.execute(
+            select(models.EstructuraHidraulica.id).where(
+                models.EstructuraHidraulica.id.in_(ids)
+            )
+        ).scalars()
+    )
+    if repetidos:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"La estructura ya existe: {', '.join(sorted(repetidos))}",
+        )
 
-    db.add(estructura)
+    # Pozos y sumideros no traen las mismas columnas; el INSERT por lotes
+    # y el COPY necesitan las mismas claves en todas las filas
+    columnas = dict.fromkeys(schemas.EstructuraHidraulicaBase.model_fields)
+    bulk_insert_estructuras(db, [{**columnas, **d.model_dump()} for d in datos])
     db.commit()
-    db.refresh(estructura)
 
-    return estructura
+    return {"ok": True, "insertadas": len(datos)}
+
+
+_Q_ESTRUCTURAS_PROYECTO = text(
+    """
+    SELECT
+      e.id,
+      e.tipo,
+      ST_AsText(e.geometria) AS geometria,
+      e.fecha_inspeccion,
+      e.hora_inspeccion,
+      e.clima_inspeccion,
+      e.tipo_via,
+      e.tipo_sistema,
+      e.material,
+      e.cono_reduccion,
+      e.altura_cono,
+      e.profundidad_pozo,
+      e.diametro_camara,
+      e.sedimentacion,
+      e.cobertura_tuberia_salida,
+      e.deposito_predomina,
+      e.flujo_represado,
+      e.nivel_cubre_cotasalida,
+      e.cota_estructura,
+      e.condiciones_investiga,
+      e.observaciones,
+      e.tipo_sumidero,
+      e.ancho_sumidero,
+      e.largo_sumidero,
+      e.altura_sumidero,
+      e.material_sumidero,
+      e.ancho_rejilla,
+      e.largo_rejilla,
+      e.altura_rejilla,
+      e.material_rejilla,
+      e.id_proyecto
+    FROM estructura_hidraulica e
+    JOIN proyecto p ON p.id = e.id_proyecto
+    WHERE e.id_proyecto = :pid
+      AND p.id_usuario = :uid
+    """
+)
 
 
 @app.get(
@@ -427,8 +699,8 @@ def crear_estructura_hidraulica(
     response_model=list[schemas.EstructuraHidraulicaOut],
 )
 def listar_estructuras_por_proyecto(
-    token: str,
     id_proyecto: int,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """
@@ -437,87 +709,53 @@ def listar_estructuras_por_proyecto(
     usando ST_AsText, para que el frontend pueda parsear lon/lat.
     No se modifica el resto de campos.
     """
-    user = get_user_by_token(db, token)
-
-    proyecto = (
-        db.query(models.Proyecto)
-        .filter(
-            models.Proyecto.id == id_proyecto,
-            models.Proyecto.id_usuario == user.id,
-        )
-        .first()
-    )
+    filas = db.execute(
+        _Q_ESTRUCTURAS_PROYECTO,
+        {"pid": id_proyecto, "uid": user.id},
+    ).mappings().all()
 
-    if not proyecto:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Proyecto no encontrado o no pertenece al usuario",
+    # El dueño ya se filtra en la consulta; solo si no hay filas hay que
+    # distinguir "proyecto vacío" de "proyecto ajeno o inexistente"
+    if not filas:
+        proyecto = db.get(
+            models.Proyecto,
+            id_proyecto,
+            options=[load_only(models.Proyecto.id, models.Proyecto.id_usuario)],
         )
 
-    filas = db.execute(
-        text(
-            """
-            SELECT
-              e.id,
-              e.tipo,
-              ST_AsText(e.geometria) AS geometria,
-              e.fecha_inspeccion,
-              e.hora_inspeccion,
-              e.clima_inspeccion,
-              e.tipo_via,
-              e.tipo_sistema,
-              e.material,
-              e.cono_reduccion,
-              e.altura_cono,
-              e.profundidad_pozo,
-              e.diametro_camara,
-              e.sedimentacion,
-              e.cobertura_tuberia_salida,
-              e.deposito_predomina,
-              e.flujo_represado,
-              e.nivel_cubre_cotasalida,
-              e.cota_estructura,
-              e.condiciones_investiga,
-              e.observaciones,
-              e.tipo_sumidero,
-              e.ancho_sumidero,
-              e.largo_sumidero,
-              e.altura_sumidero,
-              e.material_sumidero,
-              e.ancho_rejilla,
-              e.largo_rejilla,
-              e.altura_rejilla,
-              e.material_rejilla,
-              e.id_proyecto
-            FROM estructura_hidraulica e
-            WHERE e.id_proyecto = :pid
-            """
-        ),
-        {"pid": id_proyecto},
-    ).mappings().all()
+        if not proyecto or proyecto.id_usuario != user.id:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Proyecto no encontrado o no pertenece al usuario",
+            )
 
     estructuras: List[Dict[str, Any]] = [dict(r) for r in filas]
-    return estructuras
+    return _json_lista(schemas.ESTRUCTURA_LIST_ADAPTER, estructuras)
 
 
 @app.delete("/estructuras/{estructura_id}")
 def eliminar_estructura_hidraulica(
     estructura_id: str,
-    token: str,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    user = get_user_by_token(db, token)
-
+    # Para borrar basta la clave primaria (los hijos los borra la BD en
+    # cascada), pero solo si la estructura es de un proyecto del usuario
     estructura = (
         db.query(models.EstructuraHidraulica)
-        .filter(models.EstructuraHidraulica.id == estructura_id)
+        .options(load_only(models.EstructuraHidraulica.id))
+        .join(models.Proyecto, models.EstructuraHidraulica.id_proyecto == models.Proyecto.id)
+        .filter(
+            models.EstructuraHidraulica.id == estructura_id,
+            models.Proyecto.id_usuario == user.id,
+        )
         .first()
     )
 
     if not estructura:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail="Estructura no encontrada",
+            detail="Estructura no encontrada o no pertenece al usuario",
         )
 
     db.delete(estructura)
@@ -529,12 +767,10 @@ def eliminar_estructura_hidraulica(
 @app.put("/estructuras/{estructura_id}", response_model=schemas.EstructuraHidraulicaOut)
 def actualizar_estructura_hidraulica(
     estructura_id: str,
-    token: str,
     data: schemas.EstructuraHidraulicaUpdate,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    user = get_user_by_token(db, token)
-
     estructura = (
         db.query(models.EstructuraHidraulica)
         .join(models.Proyecto, models.EstructuraHidraulica.id_proyecto == models.Proyecto.id)
@@ -551,81 +787,17 @@ def actualizar_estructura_hidraulica(
             detail="Estructura no encontrada o no pertenece al usuario",
         )
 
-    if data.tipo is not None:
-        estructura.tipo = data.tipo
-
-    if data.geometria is not None:
-        estructura.geometria = data.geometria
-    if data.fecha_inspeccion is not None:
-        estructura.fecha_inspeccion = data.fecha_inspeccion
-    if data.hora_inspeccion is not None:
-        estructura.hora_inspeccion = data.hora_inspeccion
-    if data.clima_inspeccion is not None:
-        estructura.clima_inspeccion = data.clima_inspeccion
-    if data.tipo_via is not None:
-        estructura.tipo_via = data.tipo_via
-
-    if data.tipo_sistema is not None:
-        estructura.tipo_sistema = data.tipo_sistema
-    if data.material is not None:
-        estructura.material = data.material
-
-    if data.cono_reduccion is not None:
-        estructura.cono_reduccion = data.cono_reduccion
-    if data.altura_cono is not None:
-        estructura.altura_cono = data.altura_cono
-    if data.profundidad_pozo is not None:
-        estructura.profundidad_pozo = data.profundidad_pozo
-    if data.diametro_camara is not None:
-        estructura.diametro_camara = data.diametro_camara
-
-    if data.sedimentacion is not None:
-        estructura.sedimentacion = data.sedimentacion
-    if data.cobertura_tuberia_salida is not None:
-        estructura.cobertura_tuberia_salida = data.cobertura_tuberia_salida
-    if data.deposito_predomina is not None:
-        estructura.deposito_predomina = data.deposito_predomina
-    if data.flujo_represado is not None:
-        estructura.flujo_represado = data.flujo_represado
-    if data.nivel_cubre_cotasalida is not None:
-        estructura.nivel_cubre_cotasalida = data.nivel_cubre_cotasalida
-    if data.cota_estructura is not None:
-        estructura.cota_estructura = data.cota_estructura
-    if data.condiciones_investiga is not None:
-        estructura.condiciones_investiga = data.condiciones_investiga
-    if data.observaciones is not None:
-        estructura.observaciones = data.observaciones
-
-    if data.tipo_sumidero is not None:
-        estructura.tipo_sumidero = data.tipo_sumidero
-    if data.ancho_sumidero is not None:
-        estructura.ancho_sumidero = data.ancho_sumidero
-    if data.largo_sumidero is not None:
-        estructura.largo_sumidero = data.largo_sumidero
-    if data.altura_sumidero is not None:
-        estructura.altura_sumidero = data.altura_sumidero
-    if data.material_sumidero is not None:
-        estructura.material_sumidero = data.material_sumidero
-
-    if data.ancho_rejilla is not None:
-        estructura.ancho_rejilla = data.ancho_rejilla
-    if data.largo_rejilla is not None:
-        estructura.largo_rejilla = data.largo_rejilla
-    if data.altura_rejilla is not None:
-        estructura.altura_rejilla = data.altura_rejilla
-    if data.material_rejilla is not None:
-        estructura.material_rejilla = data.material_rejilla
+    # Solo los campos enviados con valor (los None se ignoran);
+    # el cambio de proyecto se valida aparte
+    cambios = data.model_dump(
+        exclude_unset=True, exclude_none=True, exclude={"id_proyecto"}
+    )
+    for campo, valor in cambios.items():
+        setattr(estructura, campo, valor)
 
     if data.id_proyecto is not None:
-        proyecto_nuevo = (
-            db.query(models.Proyecto)
-            .filter(
-                models.Proyecto.id == data.id_proyecto,
-                models.Proyecto.id_usuario == user.id,
-            )
-            .first()
-        )
-        if not proyecto_nuevo:
+        proyecto_nuevo = db.get(models.Proyecto, data.id_proyecto)
+        if not proyecto_nuevo or proyecto_nuevo.id_usuario != user.id:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Proyecto destino no encontrado o no pertenece al usuario",
@@ -633,7 +805,6 @@ def actualizar_estructura_hidraulica(
         estructura.id_proyecto = data.id_proyecto
 
     db.commit()
-    db.refresh(estructura)
 
     return estructura
 
@@ -642,41 +813,25 @@ def actualizar_estructura_hidraulica(
 #         TUBERÍAS
 # ==========================
 
+_Q_PEEK_TUBERIA_ID = text(
+    "SELECT CASE WHEN is_called THEN last_value + 1 ELSE last_value END "
+    "FROM tuberia_id_seq"
+)
+
+
 @app.get("/tuberias/next-id")
 def get_next_tuberia_id(
-    token: str,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """
-    Genera el siguiente ID global de tubería con prefijo 'tub' y
+    Devuelve el siguiente ID global de tubería con prefijo 'tub' y
     sufijo numérico incremental (ej: tub0001, tub0002, ...).
+    Solo consulta la secuencia 'tuberia_id_seq', no consume un valor:
+    el ID definitivo se asigna al crear la tubería.
     """
-    user = get_user_by_token(db, token)
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Token inválido o usuario no encontrado",
-        )
-
     prefix = "tub"
-    rows = db.query(models.Tuberia.id).all()
-
-    max_num = 0
-    for (tid,) in rows:
-        if not tid:
-            continue
-        tid_lower = tid.lower()
-        if not tid_lower.startswith(prefix):
-            continue
-        try:
-            num_part = tid[len(prefix):]
-            num = int(num_part)
-            if num > max_num:
-                max_num = num
-        except (IndexError, ValueError):
-            continue
-
-    next_num = max_num + 1
+    next_num = db.execute(_Q_PEEK_TUBERIA_ID).scalar()
     new_id = f"{prefix}{next_num:04d}"
 
     return {"id": new_id}
@@ -685,148 +840,95 @@ def get_next_tuberia_id(
 @app.post("/tuberias/", response_model=schemas.PipeOut)
 def crear_tuberia(
     data: schemas.PipeCreate,  # id se ignora, se genera en el backend
-    token: str,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """
     Crea una tubería entre dos estructuras hidráulicas.
     La geometría se construye automáticamente como LINESTRING
-    entre los POINT de inicio y destino usando ST_AsText(geometria)
-    para soportar columnas geometry/WKB.
+    entre los POINT de inicio y destino, cuyas coordenadas se leen
+    de las columnas generadas lon/lat de cada estructura.
 
     Además:
       - El ID de la tubería se genera automáticamente como 'tubXXXX'
-        de forma incremental global.
+        de forma incremental global con la secuencia 'tuberia_id_seq'
+        (atómica, sin carreras entre peticiones concurrentes).
       - La cota clave de inicio y destino se calcula como:
           cota_clave = cota_estructura - profundidad_clave
     """
-    user = get_user_by_token(db, token)
-
-    # 1) Generar ID automático para la tubería (ignora data.id)
-    prefix = "tub"
-    rows = db.query(models.Tuberia.id).all()
-    max_num = 0
-    for (tid,) in rows:
-        if not tid:
-            continue
-        tid_lower = tid.lower()
-        if not tid_lower.startswith(prefix):
-            continue
-        try:
-            num_part = tid[len(prefix):]
-            num = int(num_part)
-            if num > max_num:
-                max_num = num
-        except (IndexError, ValueError):
-            continue
-    next_num = max_num + 1
-    new_pipe_id = f"{prefix}{next_num:04d}"
-
-    # 2) Obtener estructuras de inicio y destino
-    est_inicio = db.query(models.EstructuraHidraulica).get(
-        data.id_estructura_inicio
-    )
-    est_dest = db.query(models.EstructuraHidraulica).get(
-        data.id_estructura_destino
+    # 1) Obtener estructuras de inicio y destino (con su geometría) en una
+    #    consulta y construir geometría y cotas calculadas
+    extremos = _get_extremos_tuberia(
+        db, [data.id_estructura_inicio, data.id_estructura_destino]
     )
+    fila = _fila_tuberia(data, extremos, user.id)
 
-    if not est_inicio or not est_dest:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Estructura de inicio o destino no encontrada",
-        )
+    # 2) Generar ID automático para la tubería (ignora data.id)
+    prefix = "tub"
+    next_num = db.execute(select(models.TUBERIA_ID_SEQ.next_value())).scalar()
 
-    # 3) Verificar que ambas estructuras pertenezcan a proyectos del usuario
-    proyectos_ids_usuario = {
-        p.id
-        for p in db.query(models.Proyecto)
-        .filter(models.Proyecto.id_usuario == user.id)
-        .all()
-    }
+    fila["id"] = f"{prefix}{next_num:04d}"
 
-    if (
-        est_inicio.id_proyecto not in proyectos_ids_usuario
-        or est_dest.id_proyecto not in proyectos_ids_usuario
-    ):
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Las estructuras no pertenecen a proyectos del usuario",
-        )
+    db.execute(models.INSERT_TUBERIA, fila)
+    db.commit()
 
-    # 4) Construir geometría de la tubería (LINESTRING) a partir de las geometrías de las estructuras
-    try:
-        x1, y1 = _get_point_from_structure(db, est_inicio.id)
-        x2, y2 = _get_point_from_structure(db, est_dest.id)
-    except Exception:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=(
-                "No se pudo construir la geometría de la tubería. "
-                "Verifica que las estructuras tengan geometría POINT válida."
-            ),
-        )
+    return fila
 
-    geom = f"LINESTRING({x1} {y1}, {x2} {y2})"
 
-    # 5) Calcular cota clave inicio/destino usando:
-    #    cota_clave = cota_estructura - profundidad_clave
-    cota_clave_inicio_calc = data.cota_clave_inicio
-    if est_inicio.cota_estructura is not None and data.profundidad_clave_inicio is not None:
-        cota_clave_inicio_calc = (
-            est_inicio.cota_estructura - data.profundidad_clave_inicio
-        )
-
-    cota_clave_destino_calc = data.cota_clave_destino
-    if est_dest.cota_estructura is not None and data.profundidad_clave_destino is not None:
-        cota_clave_destino_calc = (
-            est_dest.cota_estructura - data.profundidad_clave_destino
+@app.post("/tuberias/bulk")
+def crear_tuberias_bulk(
+    datos: List[schemas.PipeCreate],  # los id se ignoran, se generan en el backend
+    user: UsuarioCache = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """
+    Crea varias tuberías en una sola transacción (p. ej. importación).
+    Aplica las mismas reglas que POST /tuberias/ a cada una; si alguna
+    falla no se inserta ninguna. Devuelve los IDs generados en orden.
+    """
+    if not datos:
+        return {"ok": True, "ids": []}
+
+    # Todos los extremos en una sola consulta
+    ids_estructura = [
+        id_est
+        for d in datos
+        for id_est in (d.id_estructura_inicio, d.id_estructura_destino)
+    ]
+    extremos = _get_extremos_tuberia(db, ids_estructura)
+    filas = [_fila_tuberia(d, extremos, user.id) for d in datos]
+
+    # Reservar de una vez un ID de la secuencia por tubería
+    prefix = "tub"
+    nums = db.execute(
+        select(models.TUBERIA_ID_SEQ.next_value()).select_from(
+            func.generate_series(1, len(filas))
         )
+    ).scalars().all()
+    ids = [f"{prefix}{num:04d}" for num in nums]
+    for id_tuberia, fila in zip(ids, filas):
+        fila["id"] = id_tuberia
 
-    # 6) Crear instancia ORM con geometría, cotas calculadas e ID generado
-    tuberia = models.Tuberia(
-        id=new_pipe_id,  # usamos el ID generado
-        diametro=data.diametro,
-        material=data.material,
-        flujo=data.flujo,
-        estado=data.estado,
-        sedimento=data.sedimento,
-        cota_clave_inicio=cota_clave_inicio_calc,
-        cota_batea_inicio=data.cota_batea_inicio,
-        profundidad_clave_inicio=data.profundidad_clave_inicio,
-        profundidad_batea_inicio=data.profundidad_batea_inicio,
-        cota_clave_destino=cota_clave_destino_calc,
-        cota_batea_destino=data.cota_batea_destino,
-        profundidad_clave_destino=data.profundidad_clave_destino,
-        profundidad_batea_destino=data.profundidad_batea_destino,
-        grados=data.grados,
-        observaciones=data.observaciones,
-        geometria=geom,
-        id_estructura_inicio=data.id_estructura_inicio,
-        id_estructura_destino=data.id_estructura_destino,
-    )
-
-    db.add(tuberia)
+    bulk_insert_tuberias(db, filas)
     db.commit()
-    db.refresh(tuberia)
 
-    return tuberia
+    return {"ok": True, "ids": ids}
 
 
 @app.get("/tuberias/{estructura_id}", response_model=list[schemas.PipeOut])
 def listar_tuberias_por_estructura(
     estructura_id: str,
-    token: str,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """
     Lista las tuberías donde la estructura participa como inicio o destino.
     Solo se devuelven tuberías asociadas a proyectos del usuario.
     """
-    user = get_user_by_token(db, token)
-
     # Verificar que la estructura pertenezca a un proyecto del usuario
     estructura = (
         db.query(models.EstructuraHidraulica)
+        .options(load_only(models.EstructuraHidraulica.id))
         .join(models.Proyecto, models.EstructuraHidraulica.id_proyecto == models.Proyecto.id)
         .filter(
             models.EstructuraHidraulica.id == estructura_id,
@@ -840,21 +942,19 @@ def listar_tuberias_por_estructura(
             detail="Estructura no encontrada o no pertenece a proyectos del usuario",
         )
 
-    proyectos_ids_usuario = {
-        p.id
-        for p in db.query(models.Proyecto)
-        .filter(models.Proyecto.id_usuario == user.id)
-        .all()
-    }
-
     q = (
         db.query(models.Tuberia)
+        .options(raiseload("*"))
         .join(
             models.EstructuraHidraulica,
             models.Tuberia.id_estructura_inicio == models.EstructuraHidraulica.id,
         )
+        .join(
+            models.Proyecto,
+            models.EstructuraHidraulica.id_proyecto == models.Proyecto.id,
+        )
         .filter(
-            models.EstructuraHidraulica.id_proyecto.in_(proyectos_ids_usuario),
+            models.Proyecto.id_usuario == user.id,
             (
                 (models.Tuberia.id_estructura_inicio == estructura_id)
                 | (models.Tuberia.id_estructura_destino == estructura_id)
@@ -864,14 +964,14 @@ def listar_tuberias_por_estructura(
 
     tuberias = q.all()
 
-    return tuberias
+    return _json_lista(schemas.PIPE_LIST_ADAPTER, tuberias)
 
 
 @app.put("/tuberias/{tuberia_id}", response_model=schemas.PipeOut)
 def actualizar_tuberia(
     tuberia_id: str,
-    token: str,
     data: schemas.PipeUpdate,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """
@@ -881,8 +981,6 @@ def actualizar_tuberia(
     - id_estructura_destino
     - geometría
     """
-    user = get_user_by_token(db, token)
-
     tuberia = (
         db.query(models.Tuberia)
         .join(
@@ -906,43 +1004,11 @@ def actualizar_tuberia(
             detail="Tubería no encontrada o no pertenece a proyectos del usuario",
         )
 
-    # Actualizar campos permitidos
-    if data.diametro is not None:
-        tuberia.diametro = data.diametro
-    if data.material is not None:
-        tuberia.material = data.material
-    if data.flujo is not None:
-        tuberia.flujo = data.flujo
-    if data.estado is not None:
-        tuberia.estado = data.estado
-    if data.sedimento is not None:
-        tuberia.sedimento = data.sedimento
-
-    if data.cota_clave_inicio is not None:
-        tuberia.cota_clave_inicio = data.cota_clave_inicio
-    if data.cota_batea_inicio is not None:
-        tuberia.cota_batea_inicio = data.cota_batea_inicio
-    if data.profundidad_clave_inicio is not None:
-        tuberia.profundidad_clave_inicio = data.profundidad_clave_inicio
-    if data.profundidad_batea_inicio is not None:
-        tuberia.profundidad_batea_inicio = data.profundidad_batea_inicio
-
-    if data.cota_clave_destino is not None:
-        tuberia.cota_clave_destino = data.cota_clave_destino
-    if data.cota_batea_destino is not None:
-        tuberia.cota_batea_destino = data.cota_batea_destino
-    if data.profundidad_clave_destino is not None:
-        tuberia.profundidad_clave_destino = data.profundidad_clave_destino
-    if data.profundidad_batea_destino is not None:
-        tuberia.profundidad_batea_destino = data.profundidad_batea_destino
-
-    if data.grados is not None:
-        tuberia.grados = data.grados
-    if data.observaciones is not None:
-        tuberia.observaciones = data.observaciones
+    # Actualizar campos permitidos (solo los enviados con valor)
+    for campo, valor in data.model_dump(exclude_unset=True, exclude_none=True).items():
+        setattr(tuberia, campo, valor)
 
     db.commit()
-    db.refresh(tuberia)
 
     return tuberia
 
@@ -950,14 +1016,12 @@ def actualizar_tuberia(
 @app.delete("/tuberias/{tuberia_id}")
 def eliminar_tuberia(
     tuberia_id: str,
-    token: str,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """
     Elimina una tubería si pertenece a algún proyecto del usuario.
     """
-    user = get_user_by_token(db, token)
-
     tuberia = (
         db.query(models.Tuberia)
         .join(
@@ -991,10 +1055,86 @@ def eliminar_tuberia(
 #      MAPA / CONEXIONES
 # ==========================
 
+# Estado del mapa de un proyecto del usuario para su ETag: conteos (detectan
+# borrados) y última modificación de estructuras y tuberías. Sin fila -> 404.
+_Q_MAP_ETAG = text(
+    """
+    SELECT e.n AS n_estructuras, e.ultima AS ultima_estructura,
+           t.n AS n_tuberias, t.ultima AS ultima_tuberia
+    FROM proyecto p
+    CROSS JOIN LATERAL (
+      SELECT count(*) AS n, max(actualizado_en) AS ultima
+      FROM estructura_hidraulica
+      WHERE id_proyecto = p.id
+    ) e
+    CROSS JOIN LATERAL (
+      SELECT count(*) AS n, max(t.actualizado_en) AS ultima
+      FROM tuberia t
+      JOIN estructura_hidraulica e1
+        ON t.id_estructura_inicio = e1.id
+      WHERE e1.id_proyecto = p.id
+    ) t
+    WHERE p.id = :pid
+      AND p.id_usuario = :uid
+    """
+)
+
+
+def _etag_mapa(db: Session, proyecto_id: int, user_id: int) -> str:
+    """ETag de los datos de mapa de un proyecto; 404 si no es del usuario."""
+    estado = db.execute(
+        _Q_MAP_ETAG,
+        {"pid": proyecto_id, "uid": user_id},
+    ).first()
+    if estado is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Proyecto no encontrado o no pertenece al usuario",
+        )
+    return _etag(proyecto_id, *estado)
+
+
+_Q_MAP_DATA = text(
+    """
+    SELECT json_build_object(
+      'structures', COALESCE((
+        SELECT json_agg(json_build_object(
+          'id', e.id,
+          'tipo', e.tipo,
+          'lat', e.lat,
+          'lon', e.lon
+        ))
+        FROM estructura_hidraulica e
+        WHERE e.id_proyecto = :pid
+          AND e.lat IS NOT NULL
+      ), '[]'::json),
+      'pipes', COALESCE((
+        SELECT json_agg(json_build_object(
+          'id', t.id,
+          'id_estructura_inicio', t.id_estructura_inicio,
+          'id_estructura_destino', t.id_estructura_destino,
+          'coords', t.geojson::json -> 'coordinates'
+        ))
+        FROM tuberia t
+        JOIN estructura_hidraulica e1
+          ON t.id_estructura_inicio = e1.id
+        WHERE e1.id_proyecto = :pid
+          AND t.geometria IS NOT NULL
+          AND ST_GeometryType(t.geometria) = 'ST_LineString'
+      ), '[]'::json)
+    )::text
+    FROM proyecto p
+    WHERE p.id = :pid
+      AND p.id_usuario = :uid
+    """
+)
+
+
 @app.get("/proyectos/{proyecto_id}/map-data")
 def get_project_map_data(
     proyecto_id: int,
-    token: str,
+    request: Request,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """
@@ -1004,97 +1144,170 @@ def get_project_map_data(
       donde coords = [[lon, lat], ...]
     Usando geometría almacenada en PostGIS.
     Se asume que geometria ya está en coordenadas WGS84 (lon, lat).
+    Incluye ETag: con If-None-Match vigente responde 304 sin armar el JSON.
     """
-    user = get_user_by_token(db, token)
+    etag = _etag_mapa(db, proyecto_id, user.id)
+    no_modificado = _no_modificado(request, etag)
+    if no_modificado:
+        return no_modificado
+
+    # Todo el JSON de respuesta se arma en PostGIS en una sola consulta y se
+    # devuelve tal cual, sin recorrer filas ni re-serializar en Python:
+    #   estructuras POINT -> lat/lon, tuberías LINESTRING -> coords [[lon, lat], ...]
+    # El filtro por dueño va en la misma consulta: sin fila -> 404.
+    payload = db.execute(
+        _Q_MAP_DATA,
+        {"pid": proyecto_id, "uid": user.id},
+    ).scalar()
 
-    proyecto = (
-        db.query(models.Proyecto)
-        .filter(
-            models.Proyecto.id == proyecto_id,
-            models.Proyecto.id_usuario == user.id,
-        )
-        .first()
-    )
-    if not proyecto:
+    if payload is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Proyecto no encontrado o no pertenece al usuario",
         )
 
-    # ----- Estructuras: POINT -> lat/lon -----
-    estructuras_rows = db.execute(
-        text(
-            """
-            SELECT
-              id,
-              tipo,
-              ST_Y(geometria) AS lat,
-              ST_X(geometria) AS lon
-            FROM estructura_hidraulica
-            WHERE id_proyecto = :pid
-              AND geometria IS NOT NULL
-            """
-        ),
-        {"pid": proyecto_id},
-    ).mappings().all()
+    return Response(
+        content=payload,
+        media_type="application/json",
+        headers={"ETag": etag},
+    )
 
-    structures: List[Dict[str, Any]] = [dict(r) for r in estructuras_rows]
-
-    # ----- Tuberías: LINESTRING -> coords [[lon, lat], ...] -----
-    pipes_rows = db.execute(
-        text(
-            """
-            SELECT
-              t.id,
-              t.id_estructura_inicio,
-              t.id_estructura_destino,
-              ST_AsText(t.geometria) AS wkt
-            FROM tuberia t
-            JOIN estructura_hidraulica e1
-              ON t.id_estructura_inicio = e1.id
-            WHERE e1.id_proyecto = :pid
-              AND t.geometria IS NOT NULL
-            """
-        ),
-        {"pid": proyecto_id},
-    ).mappings().all()
 
-    pipes: List[Dict[str, Any]] = []
-    for row in pipes_rows:
-        coords = _parse_linestring_wkt(row["wkt"])
-        if not coords:
-            continue
-        pipes.append(
-            {
-                "id": row["id"],
-                "id_estructura_inicio": row["id_estructura_inicio"],
-                "id_estructura_destino": row["id_estructura_destino"],
-                "coords": coords,  # [[lon, lat], ...]
-            }
-        )
+_Q_MAP_PIPES_WKB = text(
+    """
+    SELECT
+      t.id,
+      ST_AsBinary(ST_Force2D(t.geometria), 'NDR') AS wkb
+    FROM tuberia t
+    JOIN estructura_hidraulica e1
+      ON t.id_estructura_inicio = e1.id
+    JOIN proyecto p
+      ON p.id = e1.id_proyecto
+    WHERE e1.id_proyecto = :pid
+      AND p.id_usuario = :uid
+      AND t.geometria IS NOT NULL
+      AND ST_GeometryType(t.geometria) = 'ST_LineString'
+    ORDER BY t.id
+    """
+)
 
-    return {
-        "structures": structures,
-        "pipes": pipes,
-    }
+
+@app.get("/proyectos/{proyecto_id}/map-data/pipes.bin")
+def get_project_map_pipes_bin(
+    proyecto_id: int,
+    request: Request,
+    user: UsuarioCache = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """
+    Tuberías del mapa en formato binario compacto (little-endian), para
+    que la app lea las coordenadas directamente como Float64List sin
+    parsear JSON:
+
+      uint32  n_tuberias
+      uint32  n_puntos
+      uint32  offsets[n_tuberias + 1]   puntos de la tubería i: offsets[i]..offsets[i+1]
+      (relleno con ceros hasta múltiplo de 8 bytes)
+      float64 coords[n_puntos * 2]      lon, lat intercalados
+      por cada tubería: uint16 largo + id en UTF-8
+
+    Se usa float64 y no float32: en float32 la precisión en grados
+    ronda el metro, insuficiente para pozos y tuberías.
+    El WKB 'NDR' de un LINESTRING 2D ya trae las coordenadas como float64
+    little-endian a partir del byte 9, así que solo se copian bytes.
+    Usa el mismo ETag que /map-data (304 si no hubo cambios).
+    """
+    etag = _etag_mapa(db, proyecto_id, user.id)
+    no_modificado = _no_modificado(request, etag)
+    if no_modificado:
+        return no_modificado
+
+    filas = db.execute(
+        _Q_MAP_PIPES_WKB,
+        {"pid": proyecto_id, "uid": user.id},
+    ).all()
+
+    offsets = [0]
+    coords = bytearray()
+    ids = bytearray()
+    for fila in filas:
+        wkb = fila.wkb
+        # WKB: 1 byte orden + uint32 tipo + uint32 n_puntos + coordenadas
+        n_puntos = struct.unpack_from("<I", wkb, 5)[0]
+        coords += wkb[9:9 + 16 * n_puntos]
+        offsets.append(offsets[-1] + n_puntos)
+
+        id_bytes = fila.id.encode("utf-8")
+        ids += struct.pack("<H", len(id_bytes))
+        ids += id_bytes
+
+    cabecera = struct.pack(f"<II{len(offsets)}I", len(filas), offsets[-1], *offsets)
+    relleno = b"\0" * (-len(cabecera) % 8)
+
+    return Response(
+        content=bytes(cabecera + relleno + coords + ids),
+        media_type="application/octet-stream",
+        headers={"ETag": etag},
+    )
 
 
 # ==========================
 #      REGISTRO FOTOGRÁFICO
 # ==========================
 
-@app.post("/registros-fotograficos/")
-async def crear_registro_fotografico(
-    token: str,
+_Q_FOTO_EXISTENTE = text(
+    """
+    SELECT id
+    FROM registro_fotografico
+    WHERE id_estructura = :id_estructura
+      AND tipo = :tipo
+    LIMIT 1
+    """
+)
+
+
+_Q_FOTO_ACTUALIZAR = text(
+    """
+    UPDATE registro_fotografico
+    SET imagen = :imagen
+    WHERE id = :id
+    """
+)
+
+
+_Q_FOTO_POR_ID = text(
+    """
+    SELECT id, id_estructura, tipo, imagen
+    FROM registro_fotografico
+    WHERE id = :id
+    """
+)
+
+
+_Q_FOTO_INSERTAR = text(
+    """
+    INSERT INTO registro_fotografico (id, id_estructura, tipo, imagen)
+    VALUES (:id, :id_estructura, :tipo, :imagen)
+    RETURNING id, id_estructura, tipo, imagen
+    """
+)
+
+
+# Rutas que devuelven dicts sin response_model con imágenes en base64:
+# orjson los serializa más rápido que json. Las rutas con response_model no
+# lo usan, FastAPI ya las serializa directo a JSON con Pydantic.
+@app.post("/registros-fotograficos/", response_class=ORJSONResponse)
+def crear_registro_fotografico(
     id_estructura: str = Form(...),
     tipo: str = Form(...),
     file: UploadFile = File(...),
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """
     Crea o actualiza un registro fotográfico para una estructura.
 
-    - token: se envía como query param.
+    - token: cabecera 'Authorization: Bearer <token>' (o query param 'token').
     - id_estructura: ID de la estructura hidráulica (Form).
     - tipo: 'panoramica' | 'inicial' | 'abierto' | 'final' (Form).
     - file: archivo de imagen (multipart).
@@ -1102,12 +1315,15 @@ async def crear_registro_fotografico(
     Se guarda la imagen en columna bytea (campo 'imagen').
     El ID del registro se define como: <id_estructura>-<tipo>.
     La API devuelve la imagen codificada en base64.
-    """
-    user = get_user_by_token(db, token)
 
+    Se declara como función síncrona (no async) porque todas las consultas
+    usan la Session síncrona: así FastAPI la ejecuta en el threadpool y la
+    E/S de base de datos no bloquea el event loop.
+    """
     # Verificar que la estructura exista y pertenezca a un proyecto del usuario
     estructura = (
         db.query(models.EstructuraHidraulica)
+        .options(load_only(models.EstructuraHidraulica.id))
         .join(
             models.Proyecto,
             models.EstructuraHidraulica.id_proyecto == models.Proyecto.id,
@@ -1139,59 +1355,33 @@ async def crear_registro_fotografico(
         )
 
     # Leer contenido del archivo como bytes (para columna bytea)
-    contenido = await file.read()
+    contenido = file.file.read()
 
     # ID deseado: <id_estructura>-<tipo>
     id_registro = f"{id_estructura}-{tipo_norm}"
 
     # Buscar si ya existe un registro para (id_estructura, tipo)
     existing = db.execute(
-        text(
-            """
-            SELECT id
-            FROM registro_fotografico
-            WHERE id_estructura = :id_estructura
-              AND tipo = :tipo
-            LIMIT 1
-            """
-        ),
+        _Q_FOTO_EXISTENTE,
         {"id_estructura": id_estructura, "tipo": tipo_norm},
     ).first()
 
     if existing:
         # Actualizar registro existente (imagen)
         db.execute(
-            text(
-                """
-                UPDATE registro_fotografico
-                SET imagen = :imagen
-                WHERE id = :id
-                """
-            ),
+            _Q_FOTO_ACTUALIZAR,
             {"imagen": contenido, "id": existing.id},
         )
         db.commit()
 
         row = db.execute(
-            text(
-                """
-                SELECT id, id_estructura, tipo, imagen
-                FROM registro_fotografico
-                WHERE id = :id
-                """
-            ),
+            _Q_FOTO_POR_ID,
             {"id": existing.id},
         ).mappings().first()
     else:
         # Insertar nuevo registro con ID <id_estructura>-<tipo>
         row = db.execute(
-            text(
-                """
-                INSERT INTO registro_fotografico (id, id_estructura, tipo, imagen)
-                VALUES (:id, :id_estructura, :tipo, :imagen)
-                RETURNING id, id_estructura, tipo, imagen
-                """
-            ),
+            _Q_FOTO_INSERTAR,
             {
                 "id": id_registro,
                 "id_estructura": id_estructura,
@@ -1213,10 +1403,22 @@ async def crear_registro_fotografico(
     }
 
 
-@app.get("/estructuras/{estructura_id}/registros-fotograficos")
+_Q_FOTOS_ESTRUCTURA = text(
+    """
+    SELECT id, id_estructura, tipo, imagen
+    FROM registro_fotografico
+    WHERE id_estructura = :id_estructura
+    """
+)
+
+
+@app.get(
+    "/estructuras/{estructura_id}/registros-fotograficos",
+    response_class=ORJSONResponse,
+)
 def listar_registros_fotograficos(
     estructura_id: str,
-    token: str,
+    user: UsuarioCache = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """
@@ -1225,10 +1427,9 @@ def listar_registros_fotograficos(
     La tabla en BD usa la columna 'imagen' como bytea.
     La API devuelve 'imagen' codificada en base64.
     """
-    user = get_user_by_token(db, token)
-
     estructura = (
         db.query(models.EstructuraHidraulica)
+        .options(load_only(models.EstructuraHidraulica.id))
         .join(
             models.Proyecto,
             models.EstructuraHidraulica.id_proyecto == models.Proyecto.id,
@@ -1246,13 +1447,7 @@ def listar_registros_fotograficos(
         )
 
     rows = db.execute(
-        text(
-            """
-            SELECT id, id_estructura, tipo, imagen
-            FROM registro_fotografico
-            WHERE id_estructura = :id_estructura
-            """
-        ),
+        _Q_FOTOS_ESTRUCTURA,
         {"id_estructura": estructura_id},
     ).mappings().all()
 
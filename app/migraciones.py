@@ -0,0 +1,195 @@
+import logging
+
+from sqlalchemy import CheckConstraint, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+
+from .database import Base
+from .models import ESTRUCTURA_ID_SEQS
+
+logger = logging.getLogger(__name__)
+
+# Ajustes idempotentes que Base.metadata.create_all no cubre sobre una
+# base de datos ya existente. Se ejecutan en cada arranque de la API.
+SENTENCIAS = [
+    # Alinea la secuencia de IDs de tubería con los 'tubXXXX' ya existentes
+    # (solo la adelanta, nunca la retrocede).
+    """
+    SELECT setval('tuberia_id_seq', m.max_num)
+    FROM (
+        SELECT MAX(CAST(SUBSTRING(id FROM 4) AS BIGINT)) AS max_num
+        FROM tuberia
+        WHERE lower(id) LIKE 'tub%'
+          AND SUBSTRING(id FROM 4) ~ '^[0-9]{1,18}$'
+    ) m
+    WHERE m.max_num >= (SELECT last_value FROM tuberia_id_seq)
+    """,
+    # Reemplazado por ix_estructura_hidraulica_id_prefijo_num
+    "DROP INDEX IF EXISTS ix_estructura_hidraulica_id_lower",
+    # Cubierto por ix_proyecto_id_usuario_id (mismo primer campo)
+    "DROP INDEX IF EXISTS ix_proyecto_id_usuario",
+    # Cubiertos por ix_estructura_hidraulica_id_proyecto_tipo e
+    # ix_tuberia_id_estructura_inicio_destino
+    "DROP INDEX IF EXISTS ix_estructura_hidraulica_id_proyecto",
+    "DROP INDEX IF EXISTS ix_tuberia_id_estructura_inicio",
+    # Marca de última modificación usada por los ETag
+    "ALTER TABLE proyecto ADD COLUMN IF NOT EXISTS actualizado_en timestamptz NOT NULL DEFAULT now()",
+    "ALTER TABLE estructura_hidraulica ADD COLUMN IF NOT EXISTS actualizado_en timestamptz NOT NULL DEFAULT now()",
+    "ALTER TABLE tuberia ADD COLUMN IF NOT EXISTS actualizado_en timestamptz NOT NULL DEFAULT now()",
+    # Contraseñas: varchar(128) (si hay alguna antigua más larga se avisa)
+    """
+    DO $$
+    BEGIN
+        IF (SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = 'usuario'::regclass AND attname = 'contrasenia')
+           <> 'character varying(128)' THEN
+            ALTER TABLE usuario ALTER COLUMN contrasenia TYPE varchar(128);
+        END IF;
+    EXCEPTION WHEN others THEN
+        RAISE WARNING 'usuario.contrasenia no convertida a varchar(128): %', SQLERRM;
+    END $$
+    """,
+    # tipo de estructura: texto -> enum tipo_estructura ('pozo' -> 'Pozo').
+    # Si hay valores fuera del enum se avisa y la columna queda como está.
+    """
+    DO $$
+    BEGIN
+        IF (SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = 'estructura_hidraulica'::regclass AND attname = 'tipo')
+           <> 'tipo_estructura' THEN
+            ALTER TABLE estructura_hidraulica ALTER COLUMN tipo TYPE tipo_estructura
+            USING initcap(trim(tipo))::tipo_estructura;
+        END IF;
+    EXCEPTION WHEN others THEN
+        RAISE WARNING 'estructura_hidraulica.tipo no convertida a tipo_estructura: %', SQLERRM;
+    END $$
+    """,
+] + [
+    # Convierte columnas WKT (text) o geometry sin tipo al tipo declarado en
+    # el modelo. Si hay datos que no encajan, avisa y deja la columna como está.
+    f"""
+    DO $$
+    BEGIN
+        IF (SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = '{tabla}'::regclass AND attname = 'geometria')
+           <> 'geometry({tipo},4326)' THEN
+            ALTER TABLE {tabla} ALTER COLUMN geometria TYPE geometry({tipo},4326)
+            USING CASE
+                WHEN ST_SRID(geometria::geometry) = 0 THEN ST_SetSRID(geometria::geometry, 4326)
+                ELSE ST_Transform(geometria::geometry, 4326)
+            END;
+        END IF;
+    EXCEPTION WHEN others THEN
+        RAISE WARNING 'geometria de {tabla} no convertida a geometry({tipo},4326): %', SQLERRM;
+    END $$
+    """
+    for tabla, tipo in (("estructura_hidraulica", "Point"), ("tuberia", "LineString"))
+] + [
+    # Textos cortos: text -> varchar(64). Si algún valor existente es más
+    # largo el ALTER falla; se avisa y la columna queda como está (sin truncar).
+    f"""
+    DO $$
+    BEGIN
+        IF (SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = '{tabla}'::regclass AND attname = '{columna}')
+           <> 'character varying(64)' THEN
+            ALTER TABLE {tabla} ALTER COLUMN {columna} TYPE varchar(64);
+        END IF;
+    EXCEPTION WHEN others THEN
+        RAISE WARNING '{tabla}.{columna} no convertida a varchar(64): %', SQLERRM;
+    END $$
+    """
+    for tabla, columnas in (
+        (
+            "estructura_hidraulica",
+            (
+                "tipo_sistema", "tipo_via", "clima_inspeccion",
+                "material", "material_rejilla", "material_sumidero",
+                "tipo_sumidero", "deposito_predomina", "condiciones_investiga",
+            ),
+        ),
+        ("tuberia", ("material", "estado")),
+    )
+    for columna in columnas
+] + [
+    # CHECK declarados en los modelos que falten en tablas ya existentes.
+    # NOT VALID: no se revisan las filas existentes (p. ej. contraseñas
+    # antiguas en texto plano, que se migran en el login), solo las nuevas.
+    # duplicate_object: otro worker arrancando a la vez ya la agregó.
+    f"""
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_constraint WHERE conname = '{restriccion.name}'
+        ) THEN
+            ALTER TABLE {tabla.name} ADD CONSTRAINT {restriccion.name}
+            CHECK ({restriccion.sqltext}) NOT VALID;
+        END IF;
+    EXCEPTION
+        WHEN duplicate_object THEN
+            NULL;
+        WHEN others THEN
+            RAISE WARNING '{restriccion.name} no agregada a {tabla.name}: %', SQLERRM;
+    END $$
+    """
+    for tabla in Base.metadata.sorted_tables
+    for restriccion in tabla.constraints
+    if isinstance(restriccion, CheckConstraint)
+] + [
+    # Igual para las secuencias de estructuras, por prefijo (sin distinguir
+    # mayúsculas; mismas expresiones que ix_estructura_hidraulica_id_prefijo_num)
+    f"""
+    SELECT setval('{secuencia.name}', m.max_num)
+    FROM (
+        SELECT MAX(CAST(substring(id, '^[A-Za-z]+([0-9]{{1,18}})$') AS BIGINT)) AS max_num
+        FROM estructura_hidraulica
+        WHERE lower(substring(id, '^[A-Za-z]+')) = '{prefijo}'
+    ) m
+    WHERE m.max_num >= (SELECT last_value FROM {secuencia.name})
+    """
+    for prefijo, secuencia in ESTRUCTURA_ID_SEQS.items()
+] + [
+    # Coordenadas de la estructura como columnas generadas (después de
+    # convertir geometria a geometry(Point,4326)). El modelo y las consultas
+    # del mapa / tuberías las necesitan: si no se pueden crear (p. ej. la
+    # conversión de geometria se omitió) la API no arranca.
+    f"""
+    DO $$
+    BEGIN
+        ALTER TABLE estructura_hidraulica ADD COLUMN IF NOT EXISTS {columna}
+        double precision GENERATED ALWAYS AS ({funcion}(geometria)) STORED;
+    EXCEPTION WHEN others THEN
+        RAISE EXCEPTION 'estructura_hidraulica.{columna} no creada (revisar que geometria sea geometry(Point,4326)): %', SQLERRM;
+    END $$
+    """
+    for columna, funcion in (("lat", "ST_Y"), ("lon", "ST_X"))
+] + [
+    # GeoJSON de las tuberías para el mapa (igual que lat / lon: sin la
+    # columna la API no arranca)
+    """
+    DO $$
+    BEGIN
+        ALTER TABLE tuberia ADD COLUMN IF NOT EXISTS geojson
+        text GENERATED ALWAYS AS (ST_AsGeoJSON(geometria, 15)) STORED;
+    EXCEPTION WHEN others THEN
+        RAISE EXCEPTION 'tuberia.geojson no creada (revisar que geometria sea geometry(LineString,4326)): %', SQLERRM;
+    END $$
+    """,
+]
+
+
+def aplicar_migraciones(engine: Engine) -> None:
+    with engine.begin() as conn:
+        for sentencia in SENTENCIAS:
+            conn.execute(text(sentencia))
+
+        # create_all no agrega índices nuevos a tablas que ya existían.
+        # Cada uno va en un SAVEPOINT: si no se puede crear (p. ej. el GiST
+        # de una geometria que no se pudo convertir) se avisa y se sigue.
+        for tabla in Base.metadata.sorted_tables:
+            for indice in tabla.indexes:
+                try:
+                    with conn.begin_nested():
+                        indice.create(bind=conn, checkfirst=True)
+                except DBAPIError as exc:
+                    logger.warning("No se pudo crear el índice %s: %s", indice.name, exc.orig)
@@ -1,5 +1,7 @@
+from datetime import date, datetime, time
+from typing import List, Optional
+
 from sqlalchemy import (
-    Column,
     Integer,
     String,
     Text,
@@ -10,14 +12,58 @@ from sqlalchemy import (
     ForeignKey,
     DateTime,
     UniqueConstraint,
+    CheckConstraint,
+    Sequence,
+    Index,
+    Enum,
+    Computed,
+    BigInteger,
+    cast,
+    literal_column,
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.sql import func
 from sqlalchemy import LargeBinary
+from sqlalchemy.types import TypeDecorator, UserDefinedType
 
 from .database import Base
 
 
+class Geometria(UserDefinedType):
+    """
+    Columna geometry de PostGIS con tipo y SRID fijos, p. ej. geometry(Point,4326).
+    Hacia y desde Python viaja como WKT: PostGIS la guarda en binario y la
+    convierte con ST_GeomFromText / ST_AsText dentro de la misma consulta.
+    """
+    cache_ok = True
+
+    def __init__(self, tipo: str = "GEOMETRY", srid: int = 4326):
+        self.tipo = tipo
+        self.srid = srid
+
+    def get_col_spec(self, **kw):
+        return f"geometry({self.tipo},{self.srid})"
+
+    def bind_expression(self, bindvalue):
+        return func.ST_GeomFromText(bindvalue, self.srid, type_=self)
+
+    def column_expression(self, col):
+        return func.ST_AsText(col, type_=self)
+
+
+class EnumTolerante(TypeDecorator):
+    """
+    Enum nativo de Postgres que al leer devuelve el texto tal cual, sin
+    exigir que sea uno de sus valores: en BD donde migraciones.py no pudo
+    convertir la columna a enum siguen pudiendo cargarse las filas antiguas.
+    """
+    impl = Enum
+    cache_ok = True
+
+    def result_processor(self, dialect, coltype):
+        return None
+
+
 # =====================================
 #               USUARIOS
 # =====================================
@@ -25,15 +71,65 @@ from .database import Base
 class Usuario(Base):
     __tablename__ = "usuario"
 
-    id = Column(Integer, primary_key=True, index=True)
-    usuario = Column(String, unique=True, nullable=False, index=True)
-    contrasenia = Column(String, nullable=False)
-    nombre = Column(String, nullable=False)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    usuario: Mapped[str] = mapped_column(
+        String, unique=True, nullable=False, index=True
+    )
+    # Hash 'scrypt$n$r$p$salt$hash' (ver auth_utils.hash_password, 114 caracteres)
+    contrasenia: Mapped[str] = mapped_column(String(128), nullable=False)
+    nombre: Mapped[str] = mapped_column(String, nullable=False)
 
-    proyectos = relationship(
+    proyectos: Mapped[List["Proyecto"]] = relationship(
         "Proyecto",
         back_populates="usuario",
         cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
+    __table_args__ = (
+        # Nunca contraseñas en texto plano. Las antiguas que aún lo estén
+        # se migran al iniciar sesión (en BD existentes la restricción es
+        # NOT VALID, ver migraciones.py)
+        CheckConstraint(
+            "contrasenia LIKE 'scrypt$%'",
+            name="ck_usuario_contrasenia_hash",
+        ),
+    )
+
+
+# =====================================
+#          SESIONES (TOKENS)
+# =====================================
+
+class TokenSesion(Base):
+    __tablename__ = "token_sesion"
+
+    token: Mapped[str] = mapped_column(String(64), primary_key=True)
+
+    id_usuario: Mapped[int] = mapped_column(
+        Integer,
+        ForeignKey("usuario.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+
+    expira_en: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+
+
+# =====================================
+#               MIXINS
+# =====================================
+
+class ActualizadoMixin:
+    """Última modificación (alimenta los ETag de proyectos / mapa)."""
+
+    actualizado_en: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=func.now(),
+        onupdate=func.now(),
     )
 
 
@@ -41,28 +137,36 @@ class Usuario(Base):
 #               PROYECTOS
 # =====================================
 
-class Proyecto(Base):
+class Proyecto(ActualizadoMixin, Base):
     __tablename__ = "proyecto"
 
-    id = Column(Integer, primary_key=True, index=True)
-    nombre = Column(Text, nullable=False)
-    contrato = Column(String, nullable=True)
-    contratante = Column(Text, nullable=True)
-    contratista = Column(Text, nullable=True)
-    encargado = Column(Text, nullable=True)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    nombre: Mapped[str] = mapped_column(Text, nullable=False)
+    contrato: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    contratante: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    contratista: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    encargado: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
 
-    id_usuario = Column(
+    id_usuario: Mapped[int] = mapped_column(
         Integer,
         ForeignKey("usuario.id", ondelete="CASCADE"),
         nullable=False,
     )
 
-    usuario = relationship("Usuario", back_populates="proyectos")
+    usuario: Mapped["Usuario"] = relationship("Usuario", back_populates="proyectos")
 
-    estructuras_hidraulicas = relationship(
+    estructuras_hidraulicas: Mapped[List["EstructuraHidraulica"]] = relationship(
         "EstructuraHidraulica",
         back_populates="proyecto",
         cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
+    __table_args__ = (
+        # Proyectos del usuario ordenados por id (listar_proyectos) y
+        # verificaciones de dueño (id, id_usuario); también sirve como
+        # índice de la FK id_usuario
+        Index("ix_proyecto_id_usuario_id", "id_usuario", "id"),
     )
 
 
@@ -70,146 +174,263 @@ class Proyecto(Base):
 #      ESTRUCTURA HIDRÁULICA
 # =====================================
 
-class EstructuraHidraulica(Base):
+def prefijo_id(columna):
+    """Prefijo alfabético de un ID en minúsculas: 'PZ0042' -> 'pz'."""
+    return func.lower(func.substring(columna, literal_column("'^[A-Za-z]+'")))
+
+
+def sufijo_id(columna):
+    """Sufijo numérico de un ID ('pz0042' -> 42); NULL si no es <letras><dígitos>."""
+    return cast(
+        func.substring(columna, literal_column("'^[A-Za-z]+([0-9]{1,18})$'")),
+        BigInteger,
+    )
+
+
+# Numeración de estructuras por prefijo ('pz0001', 'sm0001', 'es0001').
+# Se alinean con los IDs existentes al arrancar (ver migraciones.py).
+ESTRUCTURA_ID_SEQS = {
+    prefijo: Sequence(f"estructura_{prefijo}_id_seq", metadata=Base.metadata)
+    for prefijo in ("pz", "sm", "es")
+}
+
+# Tipos de estructura (enum nativo de Postgres, se crea con la metadata)
+TIPO_ESTRUCTURA = EnumTolerante(
+    "Pozo", "Sumidero", name="tipo_estructura", metadata=Base.metadata
+)
+
+# Medidas de la estructura que no pueden ser negativas (CHECK >= 0)
+MEDIDAS_ESTRUCTURA = (
+    "altura_cono", "profundidad_pozo", "diametro_camara",
+    "ancho_sumidero", "largo_sumidero", "altura_sumidero",
+    "ancho_rejilla", "largo_rejilla", "altura_rejilla",
+)
+
+
+class EstructuraHidraulica(ActualizadoMixin, Base):
     __tablename__ = "estructura_hidraulica"
 
-    id = Column(String, primary_key=True, index=True)
-    tipo = Column(String, nullable=False)  # Pozo / Sumidero
+    id: Mapped[str] = mapped_column(String, primary_key=True, index=True)
+    tipo: Mapped[str] = mapped_column(TIPO_ESTRUCTURA, nullable=False)  # Pozo / Sumidero
 
-    # Puede ser WKT o una columna geometry en PostGIS (la usamos vía ST_AsText en el backend)
-    geometria = Column(Text, nullable=True)
+    # geometry(Point,4326) en PostGIS; en Python se lee y escribe como WKT
+    geometria: Mapped[Optional[str]] = mapped_column(
+        Geometria("POINT"), nullable=True
+    )
 
-    fecha_inspeccion = Column(Date, nullable=True)
-    hora_inspeccion = Column(Time, nullable=True)
-    clima_inspeccion = Column(Text, nullable=True)
-    tipo_via = Column(Text, nullable=True)
+    # Coordenadas del punto calculadas por Postgres al escribir (solo lectura):
+    # el mapa y las tuberías las leen sin evaluar ST_X / ST_Y por fila
+    lat: Mapped[Optional[float]] = mapped_column(
+        Float, Computed("ST_Y(geometria)", persisted=True)
+    )
+    lon: Mapped[Optional[float]] = mapped_column(
+        Float, Computed("ST_X(geometria)", persisted=True)
+    )
+
+    fecha_inspeccion: Mapped[Optional[date]] = mapped_column(Date, nullable=True)
+    hora_inspeccion: Mapped[Optional[time]] = mapped_column(Time, nullable=True)
+    clima_inspeccion: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    tipo_via: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
 
-    tipo_sistema = Column(Text, nullable=False)
-    material = Column(Text, nullable=True)
+    tipo_sistema: Mapped[str] = mapped_column(String(64), nullable=False)
+    material: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
 
     # Pozo
-    cono_reduccion = Column(Boolean, nullable=True)
-    altura_cono = Column(Float, nullable=True)
-    profundidad_pozo = Column(Float, nullable=True)
-    diametro_camara = Column(Float, nullable=True)
+    cono_reduccion: Mapped[Optional[bool]] = mapped_column(Boolean, nullable=True)
+    altura_cono: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    profundidad_pozo: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    diametro_camara: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
 
     # Compartidos
-    sedimentacion = Column(Boolean, nullable=True)
-    cobertura_tuberia_salida = Column(Boolean, nullable=True)
-    deposito_predomina = Column(Text, nullable=True)
-    flujo_represado = Column(Boolean, nullable=True)
-    nivel_cubre_cotasalida = Column(Boolean, nullable=True)
-    cota_estructura = Column(Float, nullable=True)
-    condiciones_investiga = Column(Text, nullable=True)
-    observaciones = Column(Text, nullable=True)
+    sedimentacion: Mapped[Optional[bool]] = mapped_column(Boolean, nullable=True)
+    cobertura_tuberia_salida: Mapped[Optional[bool]] = mapped_column(
+        Boolean, nullable=True
+    )
+    deposito_predomina: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    flujo_represado: Mapped[Optional[bool]] = mapped_column(Boolean, nullable=True)
+    nivel_cubre_cotasalida: Mapped[Optional[bool]] = mapped_column(Boolean, nullable=True)
+    cota_estructura: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    condiciones_investiga: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    observaciones: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
 
     # Sumidero
-    tipo_sumidero = Column(Text, nullable=True)
-    ancho_sumidero = Column(Float, nullable=True)
-    largo_sumidero = Column(Float, nullable=True)
-    altura_sumidero = Column(Float, nullable=True)
+    tipo_sumidero: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    ancho_sumidero: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    largo_sumidero: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    altura_sumidero: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
 
-    ancho_rejilla = Column(Float, nullable=True)
-    largo_rejilla = Column(Float, nullable=True)
-    altura_rejilla = Column(Float, nullable=True)
-    material_rejilla = Column(Text, nullable=True)
+    ancho_rejilla: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    largo_rejilla: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    altura_rejilla: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    material_rejilla: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
 
-    material_sumidero = Column(Text, nullable=True)
+    material_sumidero: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
 
-    id_proyecto = Column(
+    id_proyecto: Mapped[int] = mapped_column(
         Integer,
         ForeignKey("proyecto.id", ondelete="CASCADE"),
         nullable=False,
     )
 
-    proyecto = relationship("Proyecto", back_populates="estructuras_hidraulicas")
+    proyecto: Mapped["Proyecto"] = relationship(
+        "Proyecto", back_populates="estructuras_hidraulicas"
+    )
 
     # =============================
     #     RELACIÓN CON TUBERÍAS
     # =============================
     # No usamos delete-orphan aquí porque una tubería tiene dos FKs a EstructuraHidraulica.
-    # El borrado se maneja con ondelete="CASCADE" en los ForeignKey de Tuberia.
-    tuberias_inicio = relationship(
+    # El borrado se maneja con ondelete="CASCADE" en los ForeignKey de Tuberia;
+    # passive_deletes="all" evita que el ORM intente poner esas FKs (NOT NULL) en NULL.
+    tuberias_inicio: Mapped[List["Tuberia"]] = relationship(
         "Tuberia",
         back_populates="estructura_inicio",
         foreign_keys="Tuberia.id_estructura_inicio",
+        passive_deletes="all",
     )
 
-    tuberias_destino = relationship(
+    tuberias_destino: Mapped[List["Tuberia"]] = relationship(
         "Tuberia",
         back_populates="estructura_destino",
         foreign_keys="Tuberia.id_estructura_destino",
+        passive_deletes="all",
     )
 
     # =============================
     #   RELACIÓN CON REG. FOTOGRÁFICO
     # =============================
-    registros_fotograficos = relationship(
+    registros_fotograficos: Mapped[List["RegistroFotografico"]] = relationship(
         "RegistroFotografico",
         back_populates="estructura",
         cascade="all, delete-orphan",
+        passive_deletes=True,
     )
 
+    __table_args__ = (
+        # (prefijo, sufijo numérico) del ID: /estructuras/next-id obtiene el
+        # MAX del sufijo de un prefijo leyendo una sola entrada del índice
+        Index(
+            "ix_estructura_hidraulica_id_prefijo_num",
+            # (.column: en el cuerpo de la clase `id` aún es un mapped_column)
+            prefijo_id(id.column),
+            sufijo_id(id.column),
+        ),
+        # Medidas no negativas (NULL se admite: un CHECK solo rechaza FALSE)
+        *(
+            CheckConstraint(f"{medida} >= 0", name=f"ck_estructura_hidraulica_{medida}")
+            for medida in MEDIDAS_ESTRUCTURA
+        ),
+        # Estructuras de un proyecto (listado, mapa, ETag), con filtro
+        # opcional por tipo; también sirve como índice de la FK id_proyecto
+        Index("ix_estructura_hidraulica_id_proyecto_tipo", "id_proyecto", "tipo"),
+        # Índice espacial (R-tree sobre GiST) para consultas por área / cercanía
+        Index(
+            "ix_estructura_hidraulica_geometria",
+            "geometria",
+            postgresql_using="gist",
+        ),
+    )
+
+
+# INSERT de Core reutilizable (se compila una vez y queda en la caché de SQL)
+INSERT_ESTRUCTURA = EstructuraHidraulica.__table__.insert()
+
 
 # =====================================
 #                TUBERÍAS
 # =====================================
 
-class Tuberia(Base):
+# Numeración global de las tuberías ('tub0001', 'tub0002', ...).
+# Se alinea con los IDs existentes al arrancar (ver migraciones.py).
+TUBERIA_ID_SEQ = Sequence("tuberia_id_seq", metadata=Base.metadata)
+
+
+class Tuberia(ActualizadoMixin, Base):
     __tablename__ = "tuberia"
 
-    id = Column(String, primary_key=True, index=True)
+    id: Mapped[str] = mapped_column(String, primary_key=True, index=True)
 
-    # Geometría de la tubería (LINESTRING en WKT u otro formato)
+    # Geometría de la tubería: geometry(LineString,4326), WKT en Python
     # Debe coincidir con la columna NOT NULL que ya existe en la base de datos
-    geometria = Column(Text, nullable=False)
+    geometria: Mapped[str] = mapped_column(Geometria("LINESTRING"), nullable=False)
+
+    # GeoJSON de la geometría calculado por Postgres al escribir (solo
+    # lectura). Lo usa el mapa; diferido para no traerlo en cada carga ORM.
+    geojson: Mapped[Optional[str]] = mapped_column(
+        Text,
+        Computed("ST_AsGeoJSON(geometria, 15)", persisted=True),
+        deferred=True,
+    )
 
-    diametro = Column(Float, nullable=True)
-    material = Column(Text, nullable=True)
-    flujo = Column(Boolean, nullable=True)
-    estado = Column(Text, nullable=True)
-    sedimento = Column(Boolean, default=False)
+    diametro: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    material: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    flujo: Mapped[Optional[bool]] = mapped_column(Boolean, nullable=True)
+    estado: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    sedimento: Mapped[Optional[bool]] = mapped_column(Boolean, default=False)
 
-    cota_clave_inicio = Column(Float, nullable=True)
-    cota_batea_inicio = Column(Float, nullable=True)
-    profundidad_clave_inicio = Column(Float, nullable=True)
-    profundidad_batea_inicio = Column(Float, nullable=True)
+    cota_clave_inicio: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    cota_batea_inicio: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    profundidad_clave_inicio: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    profundidad_batea_inicio: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
 
-    cota_clave_destino = Column(Float, nullable=True)
-    cota_batea_destino = Column(Float, nullable=True)
-    profundidad_clave_destino = Column(Float, nullable=True)
-    profundidad_batea_destino = Column(Float, nullable=True)
+    cota_clave_destino: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    cota_batea_destino: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    profundidad_clave_destino: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    profundidad_batea_destino: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
 
-    grados = Column(Float, nullable=True)
-    observaciones = Column(Text, nullable=True)
+    grados: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    observaciones: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
 
     # --------------------------
     # Relaciones con estructuras
     # --------------------------
-    id_estructura_inicio = Column(
+    id_estructura_inicio: Mapped[str] = mapped_column(
         String,
         ForeignKey("estructura_hidraulica.id", ondelete="CASCADE"),
         nullable=False,
     )
 
-    id_estructura_destino = Column(
+    id_estructura_destino: Mapped[str] = mapped_column(
         String,
         ForeignKey("estructura_hidraulica.id", ondelete="CASCADE"),
         nullable=False,
+        index=True,
     )
 
-    estructura_inicio = relationship(
+    estructura_inicio: Mapped["EstructuraHidraulica"] = relationship(
         "EstructuraHidraulica",
         foreign_keys=[id_estructura_inicio],
         back_populates="tuberias_inicio",
     )
 
-    estructura_destino = relationship(
+    estructura_destino: Mapped["EstructuraHidraulica"] = relationship(
         "EstructuraHidraulica",
         foreign_keys=[id_estructura_destino],
         back_populates="tuberias_destino",
     )
 
+    __table_args__ = (
+        # Tuberías entre dos estructuras; también sirve como índice de la
+        # FK id_estructura_inicio (la de destino tiene el suyo)
+        Index(
+            "ix_tuberia_id_estructura_inicio_destino",
+            "id_estructura_inicio",
+            "id_estructura_destino",
+        ),
+        # Índice espacial (R-tree sobre GiST)
+        Index("ix_tuberia_geometria", "geometria", postgresql_using="gist"),
+        CheckConstraint("diametro >= 0", name="ck_tuberia_diametro"),
+        CheckConstraint("grados BETWEEN 0 AND 360", name="ck_tuberia_grados"),
+        # Una tubería une dos estructuras distintas
+        CheckConstraint(
+            "id_estructura_inicio <> id_estructura_destino",
+            name="ck_tuberia_extremos_distintos",
+        ),
+    )
+
+
+INSERT_TUBERIA = Tuberia.__table__.insert()
+
 
 # =====================================
 #         REGISTRO FOTOGRÁFICO
@@ -218,10 +439,10 @@ class Tuberia(Base):
 class RegistroFotografico(Base):
     __tablename__ = "registro_fotografico"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
 
     # FK a la estructura hidráulica (id es String)
-    id_estructura = Column(
+    id_estructura: Mapped[str] = mapped_column(
         String,
         ForeignKey("estructura_hidraulica.id", ondelete="CASCADE"),
         nullable=False,
@@ -229,13 +450,13 @@ class RegistroFotografico(Base):
     )
 
     # Tipo de foto: panoramica / inicial / abierto / final
-    tipo = Column(String(20), nullable=False, index=True)
+    tipo: Mapped[str] = mapped_column(String(20), nullable=False, index=True)
 
     # Ruta o nombre del archivo en el servidor (relativa a la app)
-    imagen = Column(LargeBinary, nullable=False)
+    imagen: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
 
 
-    estructura = relationship(
+    estructura: Mapped["EstructuraHidraulica"] = relationship(
         "EstructuraHidraulica",
         back_populates="registros_fotograficos",
     )
@@ -1,7 +1,119 @@
+import math
+import re
 from datetime import date, time
-from typing import Optional, List, Dict, Any
-from pydantic import BaseModel
-from typing import Optional
+from typing import Annotated, Literal, Optional, List, Any, Union
+from pydantic import (
+    AfterValidator,
+    BaseModel,
+    BeforeValidator,
+    ConfigDict,
+    Discriminator,
+    Field,
+    Tag,
+    TypeAdapter,
+    create_model,
+)
+
+# Esquemas que se construyen directamente desde objetos del ORM
+_ORM_CFG = ConfigDict(from_attributes=True)
+
+# Textos cortos guardados en columnas String(64)
+Texto64 = Annotated[str, Field(max_length=64)]
+
+# Mismos límites que los CHECK de models.py (422 en vez de error de BD)
+Medida = Annotated[float, Field(ge=0)]
+Grados = Annotated[float, Field(ge=0, le=360)]
+
+
+_NUMERO_WKT = r"[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?"
+_PUNTO_WKT = re.compile(
+    rf"\s*POINT\s*\(\s*({_NUMERO_WKT})\s+({_NUMERO_WKT})\s*\)\s*", re.IGNORECASE
+)
+
+
+def _validar_punto(valor: str) -> str:
+    """
+    La columna es geometry(Point,4326): un WKT mal formado, 3D o de otro
+    tipo haría fallar el INSERT / COPY en la BD, así que se rechaza antes.
+    """
+    coincidencia = _PUNTO_WKT.fullmatch(valor)
+    if not coincidencia or not all(math.isfinite(float(n)) for n in coincidencia.groups()):
+        raise ValueError("geometria debe ser un POINT WKT 2D, p. ej. 'POINT(-74.08 4.61)'")
+    return valor
+
+
+# POINT en WKT ('POINT(lon lat)'), como lo guarda estructura_hidraulica
+PuntoWKT = Annotated[str, AfterValidator(_validar_punto)]
+
+
+def _normalizar_tipo(valor: Any) -> Any:
+    """' pozo' -> 'Pozo' (mismo criterio que initcap(trim(tipo)) en migraciones.py)."""
+    return valor.strip().capitalize() if isinstance(valor, str) else valor
+
+
+def _tipo_estructura(*tipos: str) -> Any:
+    """Literal de tipos de estructura que acepta variantes en minúsculas / con espacios."""
+    return Annotated[Literal[tipos], BeforeValidator(_normalizar_tipo)]
+
+
+# Límites que solo se validan en la entrada (altas y actualizaciones).
+# Los esquemas de salida usan los tipos simples de las clases Base, así las
+# filas antiguas que no los cumplen (textos largos cuyo ALTER a varchar(64)
+# se omitió, valores anteriores a los CHECK NOT VALID; ver migraciones.py)
+# se siguen pudiendo leer.
+_LIMITES_ENTRADA = {
+    **dict.fromkeys(
+        (
+            "clima_inspeccion", "tipo_via", "tipo_sistema", "material",
+            "deposito_predomina", "condiciones_investiga", "tipo_sumidero",
+            "material_sumidero", "material_rejilla", "estado",
+        ),
+        Texto64,
+    ),
+    **dict.fromkeys(
+        (
+            "altura_cono", "profundidad_pozo", "diametro_camara",
+            "ancho_sumidero", "largo_sumidero", "altura_sumidero",
+            "ancho_rejilla", "largo_rejilla", "altura_rejilla", "diametro",
+        ),
+        Medida,
+    ),
+    "grados": Grados,
+    "tipo": _tipo_estructura("Pozo", "Sumidero"),
+    "geometria": PuntoWKT,
+}
+
+
+def _entrada(
+    nombre: str,
+    base: type,
+    excluir: tuple = (),
+    parcial: bool = False,
+    doc: Optional[str] = None,
+    **extra,
+) -> type:
+    """
+    Esquema de entrada derivado de `base`: mismos campos (menos `excluir`)
+    con los límites de _LIMITES_ENTRADA. Con `parcial` todos son opcionales
+    y con None por defecto (actualización parcial). `extra` agrega o
+    reemplaza campos, como en create_model.
+    """
+    campos = {}
+    for campo, info in base.model_fields.items():
+        if campo in excluir:
+            continue
+        anotacion = _LIMITES_ENTRADA.get(campo)
+        if anotacion is None:
+            anotacion = info.annotation
+        elif not info.is_required():
+            anotacion = Optional[anotacion]
+
+        if parcial:
+            campos[campo] = (Optional[anotacion], None)
+        else:
+            campos[campo] = (anotacion, ... if info.is_required() else info.default)
+    campos.update(extra)
+    return create_model(nombre, __doc__=doc, **campos)
 
 # ==========================
 #         AUTH / USERS
@@ -13,6 +125,8 @@ class TokenResponse(BaseModel):
 
 
 class MeResponse(BaseModel):
+    model_config = _ORM_CFG
+
     id: int
     usuario: str
     nombre: str
@@ -30,8 +144,7 @@ class UserCreate(UserBase):
 class UserOut(UserBase):
     id: int
 
-    class Config:
-        from_attributes = True
+    model_config = _ORM_CFG
 
 
 # ==========================
@@ -55,8 +168,7 @@ class ProjectOut(ProjectBase):
     id: int
     id_usuario: int
 
-    class Config:
-        from_attributes = True
+    model_config = _ORM_CFG
 
 
 class ProjectDetailOut(ProjectOut):
@@ -79,7 +191,7 @@ class ProjectUpdate(BaseModel):
 
 class EstructuraHidraulicaBase(BaseModel):
     id: str
-    tipo: str  # "Pozo" o "Sumidero"
+    tipo: str
 
     geometria: Optional[str] = None
     fecha_inspeccion: Optional[date] = None
@@ -118,59 +230,63 @@ class EstructuraHidraulicaBase(BaseModel):
     id_proyecto: int
 
 
-class EstructuraHidraulicaCreate(EstructuraHidraulicaBase):
-    pass
+# Campos propios de cada tipo de estructura
+CAMPOS_POZO = ("cono_reduccion", "altura_cono", "profundidad_pozo", "diametro_camara")
+CAMPOS_SUMIDERO = (
+    "tipo_sumidero", "ancho_sumidero", "largo_sumidero", "altura_sumidero",
+    "material_sumidero", "ancho_rejilla", "largo_rejilla", "altura_rejilla",
+    "material_rejilla",
+)
 
 
-class EstructuraHidraulicaOut(EstructuraHidraulicaBase):
-    class Config:
-        from_attributes = True
+def _variante(nombre: str, tipo: str, excluir: tuple) -> type:
+    """
+    Esquema de alta para un solo tipo de estructura: los campos de
+    EstructuraHidraulicaBase (con los límites de entrada) menos los del
+    otro tipo, y `tipo` fijado a ese valor.
+    """
+    return _entrada(
+        nombre, EstructuraHidraulicaBase, excluir=excluir, tipo=(_tipo_estructura(tipo), ...)
+    )
 
 
-class EstructuraHidraulicaUpdate(BaseModel):
-    """
-    Campos opcionales para actualización parcial de una estructura
-    hidráulica (usado en PUT /estructuras/{id}).
+PozoCreate = _variante("PozoCreate", "Pozo", excluir=CAMPOS_SUMIDERO)
+SumideroCreate = _variante("SumideroCreate", "Sumidero", excluir=CAMPOS_POZO)
 
-    Aquí se permiten TODOS los campos de la tabla, excepto el ID.
-    """
-    tipo: Optional[str] = None
+def _variante_de(valor: Any) -> Optional[str]:
+    """Variante de alta según `tipo`, ya normalizado; None si no es texto."""
+    tipo = valor.get("tipo") if isinstance(valor, dict) else getattr(valor, "tipo", None)
+    return _normalizar_tipo(tipo) if isinstance(tipo, str) else None
 
-    geometria: Optional[str] = None
-    fecha_inspeccion: Optional[date] = None
-    hora_inspeccion: Optional[time] = None
-    clima_inspeccion: Optional[str] = None
-    tipo_via: Optional[str] = None
 
-    tipo_sistema: Optional[str] = None
-    material: Optional[str] = None
+# Alta de estructura: pydantic elige la variante por el valor de `tipo`
+# y solo valida los campos de ese tipo (los del otro se ignoran)
+EstructuraHidraulicaCreate = Annotated[
+    Union[Annotated[PozoCreate, Tag("Pozo")], Annotated[SumideroCreate, Tag("Sumidero")]],
+    Discriminator(_variante_de),
+]
 
-    cono_reduccion: Optional[bool] = None
-    altura_cono: Optional[float] = None
-    profundidad_pozo: Optional[float] = None
-    diametro_camara: Optional[float] = None
 
-    sedimentacion: Optional[bool] = None
-    cobertura_tuberia_salida: Optional[bool] = None
-    deposito_predomina: Optional[str] = None
-    flujo_represado: Optional[bool] = None
-    nivel_cubre_cotasalida: Optional[bool] = None
-    cota_estructura: Optional[float] = None
-    condiciones_investiga: Optional[str] = None
-    observaciones: Optional[str] = None
+class EstructuraHidraulicaOut(EstructuraHidraulicaBase):
+    model_config = _ORM_CFG
 
-    tipo_sumidero: Optional[str] = None
-    ancho_sumidero: Optional[float] = None
-    largo_sumidero: Optional[float] = None
-    altura_sumidero: Optional[float] = None
-    material_sumidero: Optional[str] = None
 
-    ancho_rejilla: Optional[float] = None
-    largo_rejilla: Optional[float] = None
-    altura_rejilla: Optional[float] = None
-    material_rejilla: Optional[str] = None
+EstructuraHidraulicaUpdate = _entrada(
+    "EstructuraHidraulicaUpdate",
+    EstructuraHidraulicaBase,
+    excluir=("id",),
+    parcial=True,
+    doc="""
+    Campos opcionales para actualización parcial de una estructura
+    hidráulica (usado en PUT /estructuras/{id}).
 
-    id_proyecto: Optional[int] = None
+    Aquí se permiten TODOS los campos de la tabla, excepto el ID.
+    """,
+)
+
+
+# Validación + serialización de listados completos en una sola pasada
+ESTRUCTURA_LIST_ADAPTER = TypeAdapter(List[EstructuraHidraulicaOut])
 
 
 # ==========================
@@ -180,7 +296,7 @@ class EstructuraHidraulicaUpdate(BaseModel):
 class PipeBase(BaseModel):
     id: str
 
-    diametro: Optional[float] = None          # almacenado en pulgadas
+    diametro: Optional[float] = None         # almacenado en pulgadas
     material: Optional[str] = None
     flujo: Optional[bool] = None              # ahora booleano
     estado: Optional[str] = None
@@ -203,45 +319,35 @@ class PipeBase(BaseModel):
     id_estructura_destino: str
 
 
-class PipeCreate(PipeBase):
-    """Datos que envía la app para crear una tubería."""
-    pass
+PipeCreate = _entrada(
+    "PipeCreate",
+    PipeBase,
+    doc="Datos que envía la app para crear una tubería.",
+)
 
 
 class PipeOut(PipeBase):
     """Respuesta del backend al crear / listar tuberías."""
     geometria: Optional[str] = None  # viene de la tabla tuberia
 
-    class Config:
-        from_attributes = True
+    model_config = _ORM_CFG
 
 
-class PipeUpdate(BaseModel):
-    """
+PipeUpdate = _entrada(
+    "PipeUpdate",
+    PipeBase,
+    excluir=("id", "id_estructura_inicio", "id_estructura_destino"),
+    parcial=True,
+    doc="""
     Campos opcionales para actualización parcial de una tubería
     (usado en PUT /tuberias/{tuberia_id}).
     No se permite cambiar id, id_estructura_inicio, id_estructura_destino
     ni geometría desde este esquema.
-    """
-
-    diametro: Optional[float] = None
-    material: Optional[str] = None
-    flujo: Optional[bool] = None
-    estado: Optional[str] = None
-    sedimento: Optional[bool] = None
-
-    cota_clave_inicio: Optional[float] = None
-    cota_batea_inicio: Optional[float] = None
-    profundidad_clave_inicio: Optional[float] = None
-    profundidad_batea_inicio: Optional[float] = None
+    """,
+)
 
-    cota_clave_destino: Optional[float] = None
-    cota_batea_destino: Optional[float] = None
-    profundidad_clave_destino: Optional[float] = None
-    profundidad_batea_destino: Optional[float] = None
 
-    grados: Optional[float] = None
-    observaciones: Optional[str] = None
+PIPE_LIST_ADAPTER = TypeAdapter(List[PipeOut])
 
 
 # ==========================
@@ -255,11 +361,6 @@ class MapStructureOut(BaseModel):
     lon: float
 
 
-class MapPipeOut(BaseModel):
-    id: str
-    geojson: Dict[str, Any]
-
-
 # ==========================
 #    REGISTRO FOTOGRÁFICO
 # ==========================
@@ -273,5 +374,4 @@ class RegistroFotograficoBase(BaseModel):
 class RegistroFotograficoOut(RegistroFotograficoBase):
     id: int
 
-    class Config:
-        from_attributes = True
+    model_config = _ORM_CFG